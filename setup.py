@@ -15,7 +15,6 @@ setup(
     install_requires=[
         'py-gfm',
         'requests',
-        'grequests',
         'watchdog',
     ]
 )
@@ -7,6 +7,6 @@ __author__ = 'Guillaume Gomez'
 
 
 __all__ = ['my_github', 'const', 'core', 'workflow', 'utils', 'queue_mod',
-           'cache', 'ci', 'comments', 'db_interactions', 'file_watcher',
-           'github_event', 'my_logs', 'parse', 'parse_status', 'scheduler',
-           'session', 'timeout']
+           'batch', 'cache', 'ci', 'comments', 'db_interactions',
+           'file_watcher', 'github_event', 'http_pool', 'mirrors', 'my_logs',
+           'parse', 'parse_status', 'scheduler', 'session', 'timeout']
@@ -0,0 +1,385 @@
+# Batches are groups of approved PRs of a same target branch tested with a
+# single CI build.
+#
+# The PRs are merged one after the other into an integration branch which is
+# pushed on the target repository and then tested. If the build succeeds, the
+# integration branch is pushed on the target branch, merging all the PRs at
+# once. If it fails, the batch is split in two halves which are tested one
+# after the other until the culprit(s) are found.
+#
+# Outside of rollups, a branch can be configured to test its next approved PRs
+# in batches. How many of them depends on how often PRs failed lately: the
+# more failures, the smaller the batches, so bisections remain rare.
+#
+# Merge trains are made of batches as well: each PR of the train (a "car")
+# has its own batch, whose integration branch is built on top of the one of
+# the car before it. So a car's build tests the PR along with all the ones
+# ahead of it and cars can be tested at the same time. When a car fails, the
+# ones behind it are built again without it.
+import math
+from collections import deque
+
+from ultron import ci
+from ultron import const
+from ultron import core
+from ultron import utils
+
+
+class Batch:
+    def __init__(self, kind, prs, base=None):
+        # 'rollup', 'batch' or 'train'.
+        self.kind = kind
+        # PRQueueItem list, in merge order.
+        self.prs = prs
+        # The Batch on top of which this one is built (for merge trains).
+        self.base = base
+        # Commit of the integration branch being tested.
+        self.sha = None
+        # Set once its build succeeded (for merge trains).
+        self.passed = False
+        self._ci_url = ''
+
+    # Like PRQueueItem's, the build's url is kept in core.BUILD_INDEX.
+    @property
+    def ci_url(self):
+        return self._ci_url
+
+    @ci_url.setter
+    def ci_url(self, ci_url):
+        if self._ci_url == ci_url:
+            return
+        if len(self._ci_url) > 0:
+            core.BUILD_INDEX.remove(self._ci_url, self)
+        self._ci_url = ci_url
+        if len(ci_url) > 0:
+            core.BUILD_INDEX.add(ci_url, self, 'batch')
+
+    def target_branch(self):
+        return self.prs[0].target_branch()
+
+    def repo_name(self):
+        return self.prs[0].repo_name()
+
+    def integration_branch(self):
+        if self.kind == 'train':
+            return 'ultron-train/{}/{}'.format(self.target_branch(),
+                                               self.prs[0].number())
+        return 'ultron-{}/{}'.format(self.kind, self.target_branch())
+
+    def numbers(self):
+        return ', '.join(['#{}'.format(pr.number()) for pr in self.prs])
+
+    # Returns the PRs which are still part of this batch.
+    def get_prs(self):
+        return [pr for pr in self.prs if pr.batch is self]
+
+
+# Returns the approved rollup PRs of the branch which can be tested together.
+#
+# PRs with dependencies or environment variables need their own build.
+def get_rollup_prs(q, branch):
+    return [pr for pr in q.approved_prs.get_branch_prs(branch)
+            if pr.priority == const.ROLLUP and len(pr.afters) == 0 and
+            len(pr.env_args) == 0]
+
+
+# Records the outcome of tested PRs of the branch.
+def add_to_history(q, branch, success, count=1):
+    history = q.batch_history.get(branch, None)
+    if history is None:
+        history = deque(maxlen=const.BATCH_HISTORY_SIZE)
+        q.batch_history[branch] = history
+    history.extend([success] * count)
+
+
+# Computes how many PRs should be tested together on the branch, from the
+# failure rate of its last tested PRs.
+#
+# For a failure rate `p`, testing groups of about 1 / sqrt(p) PRs is what
+# requires the fewest builds.
+def get_batch_size(q, branch, max_size):
+    history = q.batch_history.get(branch, [])
+    failures = len([success for success in history if success is False])
+    if failures == 0:
+        return max_size
+    size = int(round(1 / math.sqrt(failures / len(history))))
+    return max(1, min(max_size, size))
+
+
+# Returns the first approved PRs of the branch (at most `size`) which can be
+# tested together.
+#
+# PRs with environment variables need their own build and PRs whose
+# dependencies haven't been merged can't be tested yet. Since PRs have to be
+# tested in order, the batch stops before them.
+def get_batch_prs(q, branch, size):
+    prs = []
+    for pr in q.approved_prs.get_branch_prs(branch, size):
+        if len(pr.env_args) != 0 or q.check_afters(pr)[0] is False:
+            break
+        prs.append(pr)
+    return prs
+
+
+def _comment(pr, message):
+    core.COMMENT_QUEUE.append(utils.create_comment(pr, message))
+
+
+# Builds the integration branch of the PRs and triggers its CI build. The PRs
+# become pending if it worked.
+#
+# Returns True if a build has been started.
+def start_batch(q, kind, prs, base=None):
+    batch = Batch(kind, prs, base)
+    branch = batch.target_branch()
+    numbers = batch.numbers()
+    if base is not None:
+        numbers = '{}, {}'.format(', '.join(['#{}'.format(pr.number())
+                                             for pr in get_train_prs(base)]),
+                                  numbers)
+    sha, errors = utils.make_integration_branch(
+        prs, batch.integration_branch(), 'start_batch',
+        base.integration_branch() if base is not None else None,
+        base.sha if base is not None else None)
+    for pr in prs:
+        if pr.number() not in errors:
+            continue
+        q.update_status(pr, const.NOT_MERGEABLE)
+        msg = errors[pr.number()]
+        _comment(pr,
+                 'This pull request can\'t be merged along with {}{}'
+                 .format(numbers,
+                         ':\n{}'.format(msg) if msg is not None else '.'))
+    prs = [pr for pr in prs if pr.number() not in errors]
+    if sha is None:
+        if len(prs) > 0:
+            core.LOGS.error('start_batch: couldn\'t create the integration '
+                            'branch of {} ({})'.format(numbers,
+                                                       batch.repo_name()))
+        return False
+    batch.prs = prs
+    batch.sha = sha
+    target_repo = prs[0].get_target_repo()
+    env_args = {}
+    if kind == 'train':
+        env_args = prs[0].env_args
+    ci_url, comment = ci.trigger_ci_build(env_args, target_repo, target_repo,
+                                          branch, batch.integration_branch())
+    if ci_url is None:
+        for pr in prs:
+            q.update_status(pr, const.FAILED)
+            _comment(pr,
+                     ':broken_heart: :umbrella: Cannot trigger CI: {}'
+                     .format(comment))
+        return False
+    for pr in prs:
+        q.update_status(pr, const.PENDING)
+        pr.batch = batch
+    batch.ci_url = ci_url
+    if kind == 'train':
+        q.trains.setdefault(branch, []).append(batch)
+        _comment(prs[0],
+                 ':hourglass: PR is now __pending__ in the merge train of {} '
+                 '(position {}). CI build url: {}'.format(
+                    branch, len(q.trains[branch]), ci_url))
+        return True
+    q.batches[branch] = batch
+    for pr in prs:
+        _comment(pr,
+                 ':hourglass: PR is now __pending__ along with {} ({}). CI '
+                 'build url: {}'.format(batch.numbers(), kind, ci_url))
+    return True
+
+
+# Starts the next group of PRs waiting to be bisected on the branch (if any).
+#
+# Returns True if a build has been started.
+def start_next_bisection(q, branch):
+    groups = q.bisections.get(branch, [])
+    started = False
+    while len(groups) > 0 and started is False:
+        kind, numbers = groups.pop(0)
+        prs = [q.get_pr(number) for number in numbers]
+        prs = [pr for pr in prs
+               if pr is not None and pr.status == const.APPROVED and
+               pr.target_branch() == branch]
+        started = len(prs) > 0 and start_batch(q, kind, prs)
+    if len(groups) == 0:
+        q.bisections.pop(branch, None)
+    return started
+
+
+# Stops the batch: its build is cancelled and its PRs which are still
+# pending become approved again.
+def abort_batch(q, batch):
+    cars = q.trains.get(batch.target_branch(), [])
+    if batch in cars:
+        # The cars behind it were tested along with it.
+        stop_cars(q, batch.target_branch(), cars.index(batch))
+        return
+    if q.batches.get(batch.target_branch(), None) is batch:
+        del q.batches[batch.target_branch()]
+    if len(batch.ci_url) > 0:
+        ci.cancel_ci_build(batch.repo_name(), batch.ci_url)
+        batch.ci_url = ''
+    for pr in batch.get_prs():
+        pr.batch = None
+        if pr.status == const.PENDING:
+            q.update_status(pr, const.APPROVED)
+
+
+# Called once the CI build of the batch is over.
+def handle_batch_result(q, batch, outcome, message):
+    if batch.kind == 'train':
+        handle_car_result(q, batch, outcome, message)
+        return
+    if q.batches.get(batch.target_branch(), None) is batch:
+        del q.batches[batch.target_branch()]
+    batch.ci_url = ''
+    prs = batch.get_prs()
+    for pr in prs:
+        pr.batch = None
+    if len(prs) == 0:
+        return
+    if outcome == 'success':
+        ret, msg = utils.push_integration_branch(prs,
+                                                 [batch.integration_branch()],
+                                                 batch.sha,
+                                                 'handle_batch_result')
+        if ret is False:
+            # The target branch has probably been updated in the meantime so
+            # they need to be tested again.
+            for pr in prs:
+                q.update_status(pr, const.APPROVED)
+                _comment(pr,
+                         '{}\n\n:broken_heart: :collision: Merge failed{} '
+                         'It\'ll be tested again.'.format(
+                            message,
+                            ':\n{}\n\n'.format(msg) if msg is not None
+                            else '.'))
+            return
+        add_to_history(q, batch.target_branch(), True, len(prs))
+        for pr in prs:
+            _comment(pr, message)
+            core.DB.delete_pending_pr(pr.repo_name(), pr.number())
+            q.remove_closed(pr.number())
+        # No need to wait for github to tell us.
+        for pr in prs:
+            core.DEPENDENCIES.update_parent(pr.get_url(), False)
+        return
+    if len(prs) == 1:
+        add_to_history(q, batch.target_branch(), False)
+        q.update_status(prs[0], const.FAILED)
+        _comment(prs[0], message)
+        return
+    # To find which PR(s) broke the build, both halves are tested separately
+    # (before anything else on this branch).
+    middle = len(prs) // 2
+    halves = [(batch.kind, [pr.number() for pr in prs[:middle]]),
+              (batch.kind, [pr.number() for pr in prs[middle:]])]
+    branch = batch.target_branch()
+    q.bisections[branch] = halves + q.bisections.get(branch, [])
+    for pr in prs:
+        q.update_status(pr, const.APPROVED)
+        _comment(pr,
+                 '{}\n\nThe PRs will be tested again in smaller groups to '
+                 'find the culprit.'.format(message))
+
+
+# Returns the PRs of the train up to the given car (included).
+def get_train_prs(car):
+    prs = []
+    while car is not None:
+        prs = car.prs + prs
+        car = car.base
+    return prs
+
+
+# Stops the cars of the branch's merge train from the given position: their
+# builds are cancelled and their PRs become approved again.
+def stop_cars(q, branch, position):
+    cars = q.trains.get(branch, [])
+    stopped = cars[position:]
+    del cars[position:]
+    if len(cars) == 0:
+        q.trains.pop(branch, None)
+    for car in stopped:
+        if len(car.ci_url) > 0:
+            ci.cancel_ci_build(car.repo_name(), car.ci_url)
+            car.ci_url = ''
+        for pr in car.get_prs():
+            pr.batch = None
+            if pr.status == const.PENDING:
+                q.update_status(pr, const.APPROVED)
+    return stopped
+
+
+# Adds the next approved PRs of the branch to its merge train, as long as it
+# isn't full.
+def update_train(q, branch, depth):
+    while len(q.trains.get(branch, [])) < depth:
+        pr = q.approved_prs.get_next(branch)
+        if pr is None:
+            return
+        ret, msg = q.check_afters(pr)
+        if ret is False:
+            q.report_pending_error(pr, msg)
+            return
+        cars = q.trains.get(branch, [])
+        base = cars[-1] if len(cars) > 0 else None
+        if start_batch(q, 'train', [pr], base) is False:
+            return
+
+
+# Called once the CI build of a car of a merge train is over.
+def handle_car_result(q, car, outcome, message):
+    branch = car.target_branch()
+    cars = q.trains.get(branch, [])
+    car.ci_url = ''
+    if car not in cars:
+        # It has been stopped in the meantime.
+        return
+    pr = car.prs[0]
+    _comment(pr, message)
+    if outcome != 'success':
+        # The cars behind it have to be built again without it.
+        stop_cars(q, branch, cars.index(car))
+        q.update_status(pr, const.FAILED)
+        return
+    car.passed = True
+    # The cars at the front of the train which passed can be merged all at
+    # once: the last one contains all the others.
+    merged = []
+    for other in cars:
+        if other.passed is False:
+            break
+        merged.append(other)
+    if len(merged) == 0:
+        return
+    prs = [other.prs[0] for other in merged]
+    ret, msg = utils.push_integration_branch(
+        prs, [other.integration_branch() for other in merged],
+        merged[-1].sha, 'handle_car_result')
+    if ret is False:
+        # The target branch has probably been updated in the meantime so the
+        # whole train needs to be tested again.
+        for pr in [pr for other in stop_cars(q, branch, 0)
+                   for pr in other.prs]:
+            _comment(pr,
+                     ':broken_heart: :collision: Merge failed{} It\'ll be '
+                     'tested again.'.format(':\n{}\n\n'.format(msg)
+                                            if msg is not None else '.'))
+        return
+    del cars[:len(merged)]
+    if len(cars) == 0:
+        q.trains.pop(branch, None)
+    else:
+        # Already in the target branch.
+        cars[0].base = None
+    for pr in prs:
+        pr.batch = None
+        core.DB.delete_pending_pr(pr.repo_name(), pr.number())
+        q.remove_closed(pr.number())
+    # No need to wait for github to tell us.
+    for pr in prs:
+        core.DEPENDENCIES.update_parent(pr.get_url(), False)
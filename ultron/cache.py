@@ -1,4 +1,8 @@
+import copy
 import os
+import threading
+import time
+from collections import OrderedDict
 from pathlib import Path
 
 from ultron import const
@@ -65,3 +69,130 @@ class Cache:
         if entry is None:
             return None
         return entry.content
+
+
+class ResponseEntry:
+    def __init__(self, etag, last_modified, content, link):
+        self.etag = etag
+        self.last_modified = last_modified
+        self.content = content
+        self.link = link
+
+    def get_content(self):
+        # Callers are free to modify what they get (extending the first page
+        # with the other ones for example), so we never give them our copy.
+        return copy.copy(self.content)
+
+
+# Stores github API responses along with their ETag/Last-Modified values so
+# they can be requested again with If-None-Match/If-Modified-Since headers.
+# When github answers "304 Not Modified" (which doesn't count against the
+# rate limit), the cached content is used instead.
+#
+# Entries are keyed by URL and "Accept" header (the same URL doesn't return
+# the same thing depending on how it's asked). The token isn't part of the
+# key: read requests are spread over several tokens which all see the same
+# data (and github doesn't answer 304 to a request which can't see the
+# resource), so an entry stored with one token is used with the others. Once
+# `max_entries` is reached, the least recently used entry is dropped.
+class ResponseCache:
+    def __init__(self, max_entries=const.RESPONSE_CACHE_SIZE):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def make_key(self, url, headers):
+        return (url, headers.get('Accept', None))
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key, None)
+            if entry is not None:
+                self.entries.move_to_end(key)
+            return entry
+
+    # Returns a copy of `headers` with the conditional headers corresponding
+    # to `entry` added.
+    def conditional_headers(self, headers, entry):
+        headers = dict(headers)
+        if entry is not None:
+            if entry.etag is not None:
+                headers['If-None-Match'] = entry.etag
+            if entry.last_modified is not None:
+                headers['If-Modified-Since'] = entry.last_modified
+        return headers
+
+    def store(self, key, response_headers, content, link):
+        etag = response_headers.get('ETag', None)
+        last_modified = response_headers.get('Last-Modified', None)
+        with self.lock:
+            self.misses += 1
+            if etag is None and last_modified is None:
+                self.entries.pop(key, None)
+                return
+            self.entries[key] = ResponseEntry(etag, last_modified,
+                                              copy.copy(content), link)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def hit(self):
+        with self.lock:
+            self.hits += 1
+
+    def __str__(self):
+        return '{} entries, {} hits (304), {} misses'.format(
+            len(self.entries), self.hits, self.misses)
+
+
+# Stores pull requests resolved from their URL (mostly for after= checks),
+# keyed by owner, repository and number. An entry is only used for `ttl`
+# seconds and is dropped as soon as a webhook tells us the pull request
+# changed. Once `max_entries` is reached, the least recently used entry is
+# dropped.
+class PullCache:
+    def __init__(self, max_entries=const.PULL_CACHE_SIZE,
+                 ttl=const.PULL_CACHE_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        # key -> (expiration time, pull request)
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    # github names aren't case sensitive.
+    def _make_key(self, owner, repo_name, number):
+        return (owner.lower(), repo_name.lower(), int(number))
+
+    def get(self, owner, repo_name, number):
+        key = self._make_key(owner, repo_name, number)
+        with self.lock:
+            entry = self.entries.get(key, None)
+            if entry is not None and entry[0] > time.time():
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            if entry is not None:
+                del self.entries[key]
+            self.misses += 1
+            return None
+
+    def store(self, owner, repo_name, number, pull):
+        key = self._make_key(owner, repo_name, number)
+        with self.lock:
+            self.entries[key] = (time.time() + self.ttl, pull)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, owner, repo_name, number):
+        key = self._make_key(owner, repo_name, number)
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def __str__(self):
+        return '{} entries, {} hits, {} misses'.format(
+            len(self.entries), self.hits, self.misses)
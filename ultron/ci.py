@@ -1,6 +1,4 @@
 import json
-# pip3 install requests
-import requests
 
 from ultron import const
 from ultron import core
@@ -82,7 +80,8 @@ def trigger_ci_build(build_parameters, target_repo, from_repo, target_branch,
                         target_branch, from_branch)
 
     payload = {
-        'build_parameters': build_parameters,
+        # The given parameters are the PR's ones, they must not be modified.
+        'build_parameters': dict(build_parameters),
     }
     # Here, ensure that the DEFAULT_BRANCH is properly set,
     # taking into account:
@@ -113,10 +112,10 @@ def trigger_ci_build(build_parameters, target_repo, from_repo, target_branch,
              core.CIRCLE_TOKEN))
     req = None
     try:
-        req = requests.post('{}{}'.format(const.CI_URL, path),
-                            headers={'Content-type': 'application/json',
-                                     'Accept': 'application/json'},
-                            data=json.dumps(payload))
+        req = core.HTTP_POOL.post('{}{}'.format(const.CI_URL, path),
+                                  headers={'Content-type': 'application/json',
+                                           'Accept': 'application/json'},
+                                  data=json.dumps(payload))
         data = get_requests_json(req)
         build_url = data.get('build_url', None)
         core.LOGS.info('trigger_ci_build: Received CI answer for PR in {}'
@@ -150,9 +149,9 @@ def cancel_ci_build(project, ci_url):
             core.CIRCLE_TOKEN))
     try:
         data = get_requests_json(
-            requests.post('{}{}'.format(const.CI_URL, path),
-                          headers={'Content-type': 'application/json',
-                                   'Accept': 'application/json'}))
+            core.HTTP_POOL.post('{}{}'.format(const.CI_URL, path),
+                                headers={'Content-type': 'application/json',
+                                         'Accept': 'application/json'}))
         if 'canceled' in data:
             return data['canceled']
     except Exception as e:
@@ -175,8 +174,8 @@ def get_ci_status(project, project_owner, ci_url):
             core.CIRCLE_TOKEN))
     try:
         data = get_requests_json(
-            requests.get('{}{}'.format(const.CI_URL, path),
-                         headers={'Accept': 'application/json'}))
+            core.HTTP_POOL.get('{}{}'.format(const.CI_URL, path),
+                               headers={'Accept': 'application/json'}))
         if 'status' in data:
             return data['status']
     except Exception as e:
@@ -204,34 +203,49 @@ def handle_ci_response(ci_event):
         }
         message = messages[outcome].format(build_url)
 
-        for queue in core.QUEUES:
-            for pr in queue['prs']:
-                if pr.try_ci_url == build_url:
-                    pr.try_ci_url = ''
-                    core.COMMENT_QUEUE.prepend(
-                        utils.create_comment(pr, message))
-                    return
-                elif pr.ci_url == build_url:
-                    core.COMMENT_QUEUE.prepend(
-                        utils.create_comment(pr, message))
-                    pr.ci_url = ''
-                    if outcome != 'success':
-                        queue['prs'].update_status(pr, const.FAILED)
-                    else:
-                        ret, msg = queue['prs'].merge_pr(pr)
-                        if ret is False:
-                            if msg is None:
-                                msg = (':broken_heart: :collision: Merge '
-                                       'failed. Take a look at the logs for '
-                                       'more information.')
-                            else:
-                                msg = (':broken_heart: :collision: Merge '
-                                       'failed: {}'.format(msg))
-                            core.COMMENT_QUEUE.prepend(
-                                utils.create_comment(pr, msg))
-                            pr.set_last_error(None)
-                    queue['prs'].update_next_to_pending()
-                    return
+        payload = ci_event['payload']
+        pr, kind = core.BUILD_INDEX.get(build_url,
+                                        payload.get('username', None),
+                                        payload.get('reponame', None),
+                                        payload.get('build_num', None))
+        if pr is None:
+            return
+        if kind == 'batch':
+            # Not a PR but a batch.Batch.
+            queue = core.QUEUES.repos.get(pr.repo_name(), None)
+            if queue is not None:
+                queue.handle_batch_result(pr, outcome, message)
+                queue.update_next_to_pending()
+            return
+        queue = core.QUEUES.repos.get(pr.repo_name(), None)
+        if queue is None or queue.get_pr(pr.number()) is not pr:
+            # The PR isn't in the queue anymore.
+            return
+        if kind == 'try_ci_url':
+            pr.try_ci_url = ''
+            core.COMMENT_QUEUE.prepend(
+                utils.create_comment(pr, message))
+            return
+        core.COMMENT_QUEUE.prepend(
+            utils.create_comment(pr, message))
+        pr.ci_url = ''
+        queue.add_test_outcome(pr, outcome == 'success')
+        if outcome != 'success':
+            queue.update_status(pr, const.FAILED)
+        else:
+            ret, msg = queue.merge_pr(pr)
+            if ret is False:
+                if msg is None:
+                    msg = (':broken_heart: :collision: Merge '
+                           'failed. Take a look at the logs for '
+                           'more information.')
+                else:
+                    msg = (':broken_heart: :collision: Merge '
+                           'failed: {}'.format(msg))
+                core.COMMENT_QUEUE.prepend(
+                    utils.create_comment(pr, msg))
+                pr.set_last_error(None)
+        queue.update_next_to_pending()
     else:
         core.LOGS.info('Got a CI event for "{}" with status "{}"'.format(
                         build_url, outcome))
@@ -12,6 +12,7 @@ CONFIG_FILE = 'config.json'
 AUTHORIZATION_CONF = 'repositories.json'
 CI_URL = 'http://ci.ironmann.io'
 GH_API_URL = 'https://api.github.com'
+GH_GRAPHQL_URL = 'https://api.github.com/graphql'
 GH_URL = 'https://github.com'
 
 MAX_LOGS = 500
@@ -21,5 +22,99 @@ FORBIDDEN_FILES = [CONFIG_FILE, AUTHORIZATION_CONF, '.py']
 ONE_DAY = 60 * 60 * 24
 SCHEDULE_DELAY = 60 * 10  # 10 minutes
 
+# Size of the keep-alive connection pool for each host. Hosts which aren't
+# listed here use HTTP_POOL_DEFAULT_SIZE. Can be overwritten with the
+# "http_pool_sizes" key of the configuration file.
+HTTP_POOL_DEFAULT_SIZE = 10
+HTTP_POOL_SIZES = {
+    'api.github.com': 20,
+}
+
+# Connect and read timeouts (in seconds) of every outbound HTTP request.
+HTTP_CONNECT_TIMEOUT = 5
+HTTP_READ_TIMEOUT = 30
+# Idempotent requests (GET, PUT...) failing because of the network or of a
+# server error are sent again up to HTTP_MAX_RETRIES times, waiting
+# HTTP_RETRY_BACKOFF * 2^retry seconds (plus some jitter) between each try.
+HTTP_MAX_RETRIES = 3
+HTTP_RETRY_BACKOFF = 0.5
+HTTP_RETRY_STATUS_CODES = [500, 502, 503, 504]
+# After HTTP_BREAKER_THRESHOLD failures in a row on a host, requests to it
+# fail right away for HTTP_BREAKER_COOLDOWN seconds. Then one request is let
+# through to check if the host is back.
+HTTP_BREAKER_THRESHOLD = 5
+HTTP_BREAKER_COOLDOWN = 30
+
+# Bare mirrors of the repositories used by the git operations are kept in
+# MIRRORS_PATH. When they take more than MIRRORS_MAX_SIZE bytes, the least
+# recently used ones are removed. Can be overwritten with the "mirrors_path"
+# and "mirrors_max_size" keys of the configuration file.
+MIRRORS_PATH = 'mirrors'
+MIRRORS_MAX_SIZE = 20 * 1024 * 1024 * 1024  # 20 GB
+# Timeouts (in seconds) of the creation and of the update of a mirror.
+MIRROR_CLONE_TIMEOUT = 60 * 60
+MIRROR_FETCH_TIMEOUT = 60 * 10
+# Mirrors are compacted (if git thinks they need it, see "git gc --auto") and
+# their size is computed again once every MIRROR_GC_INTERVAL updates.
+MIRROR_GC_INTERVAL = 20
+# Maximum number of worktrees of each mirror, which is how many operations can
+# run at the same time on a repository. Can be overwritten with the
+# "worktrees_per_mirror" key of the configuration file.
+WORKTREES_PER_MIRROR = 4
+
+# Maximum number of github API responses kept for conditional requests.
+RESPONSE_CACHE_SIZE = 5000
+# Maximum number of pull requests resolved from their URL (for after= checks)
+# kept in memory and how long (in seconds) they're considered up to date.
+# Webhook events invalidate them sooner.
+PULL_CACHE_SIZE = 1000
+PULL_CACHE_TTL = 60
+
+# Priority classes of github API requests. The lower the value, the more
+# important the request.
+GH_PRIORITY_MERGE = 0  # merges and CI triggers
+GH_PRIORITY_WEBHOOK = 1  # webhook handling
+GH_PRIORITY_BACKGROUND = 2  # startup comment scans and dashboard lookups
+# When the remaining rate limit budget of a token goes below the reserve of a
+# priority class (a fraction of the token's limit, so the unauthenticated
+# budget of 60 requests per hour gets small reserves as well), its requests
+# are delayed (for at most the given number of seconds) until the rate limit
+# is reset.
+GH_RATE_LIMIT_RESERVES = {
+    GH_PRIORITY_MERGE: 0,
+    GH_PRIORITY_WEBHOOK: 0.02,
+    GH_PRIORITY_BACKGROUND: 0.1,
+}
+GH_RATE_LIMIT_MAX_WAITS = {
+    GH_PRIORITY_MERGE: 0,
+    GH_PRIORITY_WEBHOOK: 30,
+    GH_PRIORITY_BACKGROUND: 60 * 60,
+}
+
+# Maximum number of github requests running at the same time (per event loop
+# and overall) and timeout (in seconds) of each of them, retries included. The
+# timeout is a bit longer than the worst case of HTTPPool.request (every try
+# timing out and the longest waits between them) so it's only reached if
+# something goes really wrong: the request keeps running in its thread after
+# it.
+GH_MAX_CONCURRENT_REQUESTS = 8
+GH_REQUEST_TIMEOUT = ((HTTP_MAX_RETRIES + 1) *
+                      (HTTP_CONNECT_TIMEOUT + HTTP_READ_TIMEOUT) +
+                      2 * HTTP_RETRY_BACKOFF * (2 ** HTTP_MAX_RETRIES - 1) +
+                      10)
+# Number of pull requests fetched by each graphql request at startup.
+GH_GRAPHQL_PAGE_SIZE = 50
+# How long (in seconds) we keep sending requests of a repository with the
+# token after an unauthenticated one failed, if github didn't tell us when
+# the unauthenticated rate limit will be reset.
+GH_ROUTE_RELEARN_DELAY = 60 * 60
+
+# Number of the last tested PRs of a branch used to compute its failure rate,
+# which determines how many PRs are tested in a same batch.
+BATCH_HISTORY_SIZE = 50
+
+# Number of repositories loaded at the same time at startup.
+STARTUP_WORKERS = 8
+
 SCHEDULER_PATH = 'scheduler'
 FILE_WATCHER_PATH = 'file_watcher'
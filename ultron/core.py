@@ -6,11 +6,13 @@ import sys
 from ultron import const
 from ultron import utils
 from ultron.db_interactions import DBInteractions
-from ultron.cache import Cache
+from ultron.cache import Cache, PullCache, ResponseCache
 from ultron.comments import CommentQueue
 from ultron.file_watcher import FileWatcher, Ignorer
+from ultron.http_pool import HTTPPool
+from ultron.mirrors import MirrorCache
 from ultron.my_logs import Logs
-from ultron.queue_mod import Queues
+from ultron.queue_mod import BuildIndex, DependencyGraph, Queues
 from ultron.scheduler import Scheduler
 
 
@@ -31,6 +33,12 @@ COMMENT_QUEUE = CommentQueue()
 FILE_WATCHER = FileWatcher()
 SCHEDULER = Scheduler()
 CACHE = Cache()
+HTTP_POOL = HTTPPool()
+MIRRORS = MirrorCache()
+RESPONSE_CACHE = ResponseCache()
+PULL_CACHE = PullCache()
+BUILD_INDEX = BuildIndex()
+DEPENDENCIES = DependencyGraph()
 SESSIONS = None
 
 
@@ -43,6 +51,23 @@ def check_keys(keys, dic, func_name, filename):
     return True
 
 
+# Returns the "branch name -> positive number" dictionary of the repository
+# entry `key` or None if it's invalid.
+def get_branch_numbers(key, repository, repo_name):
+    values = repository.get(key, {})
+    if values.__class__.__name__ != 'dict':
+        LOGS.error('init_workflow failed: "{}" on repository "{}" should be '
+                   'a dictionary.'.format(key, repo_name))
+        return None
+    for branch, value in values.items():
+        if value.__class__.__name__ != 'int' or value < 1:
+            LOGS.error('init_workflow failed: "{}" on repository "{}" '
+                       'should only contain positive numbers (not on "{}").'
+                       .format(key, repo_name, branch))
+            return None
+    return values
+
+
 def init_conf(filename):
     try:
         conf = ''
@@ -127,8 +152,15 @@ def init_workflow(workflow, file_path, workflow_id):
         else:
             LOGS.info('No "branch_mapping" found for "{}" repository'.format(
                       entry))
+        merge_trains = get_branch_numbers('merge_trains',
+                                          repositories[entry], entry)
+        batches = get_branch_numbers('batches', repositories[entry], entry)
+        if merge_trains is None or batches is None:
+            return None
         repo_values.append({'branch_mapping': branch_mapping,
                             'reviewers': reviewers,
+                            'merge_trains': merge_trains,
+                            'batches': batches,
                             'name': entry})
     return Workflow(repo_values, tester_repository, global_reviewers)
 
@@ -229,10 +261,19 @@ def load_conf(file_path, workflows=None):
         return
     LOGS.info('The configuration has been updated, updating corresponding'
               ' information...')
+    # "hubtoken" can either be a token or a list of tokens. In the second
+    # case, the first one is the bot identity (used to write on github) and
+    # read requests are spread over all of them.
+    gh_tokens = conf['hubtoken']
+    if not isinstance(gh_tokens, list):
+        gh_tokens = [gh_tokens]
+    if len(gh_tokens) == 0:
+        LOGS.error('load_conf: "hubtoken" cannot be an empty list.')
+        return None
     memconf = {
         'CIRCLE_TOKEN': conf['citoken'],
-        'GITHUB_TOKEN': conf['hubtoken'],
-        'GITHUB': Github(conf['hubtoken']),
+        'GITHUB_TOKEN': gh_tokens[0],
+        'GITHUB': Github(gh_tokens[0], gh_tokens),
         'USERNAME': conf['username'],
         'ORGANIZATION': conf['organization'],
         'QUEUES': QUEUES,
@@ -240,6 +281,13 @@ def load_conf(file_path, workflows=None):
         'CLIENT_SECRET': conf['client_secret'],
         'PORT': conf['http_port'],
     }
+    # Applied right away so the (potential) organization switch below already
+    # benefits from the new pool sizes.
+    HTTP_POOL.configure(conf.get('http_pool_sizes', const.HTTP_POOL_SIZES))
+    MIRRORS.configure(conf.get('mirrors_path', const.MIRRORS_PATH),
+                      conf.get('mirrors_max_size', const.MIRRORS_MAX_SIZE),
+                      conf.get('worktrees_per_mirror',
+                               const.WORKTREES_PER_MIRROR))
     if ORGANIZATION != memconf['ORGANIZATION']:
         # OK, here we need to refresh EVERY repository we have. Quite huge.
         try:
@@ -343,6 +391,10 @@ def init():
         sys.exit(4)
     FILE_WATCHER.watch(const.CONFIG_FILE, config_file_event)
     FILE_WATCHER.watch(const.AUTHORIZATION_CONF, authorization_file_event)
+    LOGS.info('HTTP connections after startup: {}'.format(HTTP_POOL))
+    LOGS.info('Github response cache after startup: {}'
+              .format(RESPONSE_CACHE))
+    LOGS.info('Pull request cache after startup: {}'.format(PULL_CACHE))
     # Starting web sessions.
     SESSIONS = Sessions()
 
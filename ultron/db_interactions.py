@@ -17,6 +17,19 @@ class DBInteractions:
         db = self.connect_to_db()
         self.execute('CREATE TABLE IF NOT EXISTS {} ({})'.format(
                         self.table_name, fields), db)
+        # State of every PR of the queues (and the last comment read), so
+        # only the newer comments have to be parsed at startup.
+        self.snapshot_table_name = 'queue_snapshot'
+        fields = ('pull_request text primary key not null,'
+                  'priority text not null,'
+                  'afters text not null,'
+                  'env_args text not null,'
+                  'status text not null,'
+                  'sha text not null,'
+                  'last_error text,'
+                  'last_comment_id integer not null')
+        self.execute('CREATE TABLE IF NOT EXISTS {} ({})'.format(
+                        self.snapshot_table_name, fields), db)
 
     def _create_id(self, repo_name, pr_number):
         return "'{}/{}'".format(repo_name, pr_number)
@@ -113,6 +126,66 @@ class DBInteractions:
             # It's not really a problem if a removal failed but better log it.
             core.LOGS.error("delete_pending_pr failed: {}".format(e))
 
+    # `entries` is a list of dictionaries with the following keys:
+    # 'repo_name', 'number', 'priority', 'afters', 'env_args', 'status',
+    # 'sha', 'last_error' and 'last_comment_id'. Everything is written at
+    # once.
+    def save_queue_snapshot(self, entries, removed):
+        if len(entries) == 0 and len(removed) == 0:
+            return True
+        try:
+            db = self.connect_to_db()
+            cursor = db.cursor()
+            cursor.executemany(
+                'INSERT OR REPLACE INTO {} VALUES(?,?,?,?,?,?,?,?)'
+                .format(self.snapshot_table_name),
+                [('{}/{}'.format(entry['repo_name'], entry['number']),
+                  str(entry['priority']),
+                  json.dumps(entry['afters']),
+                  json.dumps(entry['env_args']),
+                  entry['status'],
+                  entry['sha'] if entry['sha'] is not None else '',
+                  entry['last_error'],
+                  entry['last_comment_id']) for entry in entries])
+            cursor.executemany(
+                'DELETE FROM {} WHERE pull_request=?'
+                .format(self.snapshot_table_name),
+                [('{}/{}'.format(repo_name, number),)
+                 for repo_name, number in removed])
+            db.commit()
+        except Exception as e:
+            core.LOGS.error('save_queue_snapshot failed: {}'.format(e))
+            return False
+        return True
+
+    def get_queue_snapshot(self, repo_name):
+        prs = {}
+        try:
+            db = self.connect_to_db()
+            cursor = db.cursor()
+            cursor.execute('SELECT * FROM {} WHERE pull_request LIKE ?'
+                           .format(self.snapshot_table_name),
+                           ('{}/%'.format(repo_name),))
+            for row in cursor.fetchall():
+                pr = row[0].rsplit('/', 1)
+                if len(pr) != 2 or pr[0] != repo_name:
+                    continue
+                try:
+                    prs[int(pr[1])] = {
+                        'priority': row[1],
+                        'afters': json.loads(row[2]),
+                        'env_args': json.loads(row[3]),
+                        'status': row[4],
+                        'sha': row[5],
+                        'last_error': row[6],
+                        'last_comment_id': row[7],
+                    }
+                except Exception:
+                    continue
+        except Exception as e:
+            core.LOGS.error('get_queue_snapshot failed: {}'.format(e))
+        return prs
+
     def execute(self, request, db):
         try:
             cursor = db.cursor()
@@ -44,11 +44,21 @@ def handle_push(github_event):
     try:
         original_branch = github_event['ref'].replace("refs/heads/", "")
 
-        pr = core.QUEUES.get_pr_from_head_commit(
-            github_event['repository']['name'], github_event['before'])
+        repo_name = github_event['repository']['name']
+        pr = core.QUEUES.get_pr_from_head_commit(repo_name,
+                                                 github_event['before'])
+        if pr is None:
+            # The "synchronize" event of the PR might have been received
+            # first.
+            pr = core.QUEUES.get_pr_from_head_commit(repo_name,
+                                                     github_event['after'])
         if pr is not None and pr.from_branch() == original_branch:
             core.LOGS.info('PR {}/#{} has been updated'.format(
                             pr.repo_name(), pr.number()))
+            core.QUEUES.update_head_commit(repo_name, pr.number(),
+                                           github_event['after'])
+            core.PULL_CACHE.invalidate(pr.repo_owner(), pr.repo_name(),
+                                       pr.number())
             q = core.QUEUES.get_queue(
                 github_event['repository']['name'])
             if q is not None:
@@ -150,24 +160,40 @@ def handle_comment(github_event):
 
         core.QUEUES.parse_comment(
             repo_name, poster, pr_number,
-            github_event['comment']['body'])
+            github_event['comment']['body'],
+            github_event['comment'].get('id', None))
         core.COMMENT_QUEUE.flush()
     except Exception as ex:
         core.LOGS.error('handle_comment failed: {}'.format(ex), ex)
 
 
 def handle_pr_event(github_event):
+    # Whatever happened, we need to get this PR again next time.
+    pull_request = github_event['pull_request']
+    core.PULL_CACHE.invalidate(pull_request['base']['repo']['owner']['login'],
+                               pull_request['base']['repo']['name'],
+                               pull_request['number'])
     if (github_event['action'] == 'opened'
             or github_event['action'] == 'reopened'):
         pr_event = github_event['pull_request']
         core.QUEUES.add_pr(
             core.GITHUB.create_pull(pr_event))
+        core.DEPENDENCIES.update_parent(pr_event['html_url'], True)
     elif github_event['action'] == 'closed':
         # If the following condition is true, it hasn't been merged.
         # if github_event['base']['merged'] is False:
         core.QUEUES.remove_closed(
             github_event['pull_request']['base']['repo']['name'],
             github_event['pull_request']['number'])
+        # PRs which were waiting for this one can go on.
+        core.DEPENDENCIES.update_parent(
+            github_event['pull_request']['html_url'], False)
+    elif github_event['action'] == 'synchronize':
+        # The rest is handled with the push event.
+        core.QUEUES.update_head_commit(
+            github_event['pull_request']['base']['repo']['name'],
+            github_event['pull_request']['number'],
+            github_event['pull_request']['head']['sha'])
     elif (github_event['action'] == 'edited'
           and github_event['pull_request']['state'] == 'open'):
         pr_event = github_event['pull_request']
@@ -188,6 +214,10 @@ def handle_pr_event(github_event):
             old_target_branch,
             utils.safe_get(github_event, 'repository', 'default_branch'),
             nb_commits)
+        # Doesn't cost anything and keeps the head commits index in sync.
+        core.QUEUES.update_head_commit(pr_event['base']['repo']['name'],
+                                       pr_event['number'],
+                                       pr_event['head']['sha'])
 
 
 def handle_event(github_event):
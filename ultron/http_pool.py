@@ -0,0 +1,257 @@
+import random
+import threading
+import time
+from urllib.parse import urlparse
+# pip3 install requests
+import requests
+from requests.adapters import HTTPAdapter
+
+from ultron import const
+from ultron import core
+
+
+IDEMPOTENT_METHODS = ['GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE']
+
+
+# Makes requests to a host fail right away when the last ones all failed
+# (the host is down or degraded), instead of waiting for timeouts and
+# blocking everything behind them.
+#
+# * 'closed': requests are sent normally.
+# * 'open': too many failures in a row, requests aren't sent until the
+#   cooldown is over.
+# * 'half-open': the cooldown is over, one request is sent to check if the
+#   host is back. If it succeeds, the breaker is closed, otherwise it's
+#   opened again.
+class CircuitBreaker:
+    def __init__(self, host, threshold=const.HTTP_BREAKER_THRESHOLD,
+                 cooldown=const.HTTP_BREAKER_COOLDOWN):
+        self.host = host
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.lock = threading.Lock()
+        self.state = 'closed'
+        self.failures = 0
+        self.opened_at = 0
+        self.trial_running = False
+
+    def before_request(self):
+        with self.lock:
+            if self.state == 'closed':
+                return
+            if self.state == 'open':
+                if time.time() - self.opened_at < self.cooldown:
+                    raise Exception('Circuit breaker open for "{}", request '
+                                    'not sent'.format(self.host))
+                self._set_state('half-open')
+            if self.trial_running:
+                raise Exception('Circuit breaker half-open for "{}", request '
+                                'not sent'.format(self.host))
+            self.trial_running = True
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.trial_running = False
+            if self.state != 'closed':
+                self._set_state('closed')
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            self.trial_running = False
+            if (self.state == 'half-open' or
+                    (self.state == 'closed' and
+                     self.failures >= self.threshold)):
+                self.opened_at = time.time()
+                self._set_state('open')
+
+    # Must be called with `self.lock` held.
+    def _set_state(self, state):
+        self.state = state
+        message = 'Circuit breaker for "{}" is now {} ({} failures in a row)'
+        message = message.format(self.host, state, self.failures)
+        if state == 'open':
+            core.LOGS.error(message)
+        else:
+            core.LOGS.info(message)
+
+
+# Keep-alive HTTP layer. Every outbound API request should go through the
+# instance stored in `core.HTTP_POOL` so TCP + TLS connections get reused
+# instead of being opened again for each call.
+#
+# It also takes care of the resilience part: every request gets a timeout,
+# idempotent requests are retried (with a jittered exponential backoff) on
+# network and server errors and each host has a circuit breaker.
+#
+# requests.Session isn't thread-safe so each thread gets its own one. However,
+# all of them mount the same HTTPAdapter instances, so the underlying urllib3
+# connection pools (and therefore the connections) are shared between every
+# thread. There is one adapter (so one pool) per host, which allows to set a
+# different pool size for each host.
+class HTTPPool:
+    def __init__(self, pool_sizes=None,
+                 default_size=const.HTTP_POOL_DEFAULT_SIZE):
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        # Prefix ('scheme://host') -> HTTPAdapter.
+        self.adapters = {}
+        # Host -> pool size.
+        self.pool_sizes = {}
+        # Host -> CircuitBreaker.
+        self.breakers = {}
+        self.default_size = default_size
+        # Incremented every time the adapters are dropped so threads know they
+        # have to rebuild their session.
+        self.generation = 0
+        self.configure(const.HTTP_POOL_SIZES if pool_sizes is None
+                       else pool_sizes)
+
+    # Can be called at any time (when the configuration file is updated for
+    # example). Existing pools are closed and recreated lazily with their new
+    # size.
+    def configure(self, pool_sizes, default_size=None):
+        if default_size is None:
+            default_size = self.default_size
+        with self.lock:
+            if (pool_sizes == self.pool_sizes and
+                    default_size == self.default_size):
+                return
+            self.pool_sizes = dict(pool_sizes)
+            self.default_size = default_size
+            old_adapters = self.adapters
+            self.adapters = {}
+            self.generation += 1
+        for adapter in old_adapters.values():
+            adapter.close()
+
+    def _get_prefix(self, url):
+        parsed = urlparse(url)
+        return '{}://{}'.format(parsed.scheme, parsed.netloc), parsed.netloc
+
+    # Tokens can be given in the query string (like CircleCI's), so it's not
+    # logged.
+    def _get_loggable_url(self, url):
+        parsed = urlparse(url)
+        return '{}://{}{}'.format(parsed.scheme, parsed.netloc, parsed.path)
+
+    def _get_adapter(self, prefix, host):
+        with self.lock:
+            adapter = self.adapters.get(prefix, None)
+            if adapter is None:
+                size = self.pool_sizes.get(host, self.default_size)
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=size)
+                self.adapters[prefix] = adapter
+            return adapter
+
+    # Returns the session of the current thread with the pooled adapter of
+    # `url`'s host mounted on it.
+    def get_session(self, url):
+        session = getattr(self.local, 'session', None)
+        if (session is None or
+                getattr(self.local, 'generation', None) != self.generation):
+            if session is not None:
+                session.close()
+            session = requests.Session()
+            self.local.session = session
+            self.local.generation = self.generation
+        prefix, host = self._get_prefix(url)
+        adapter = self._get_adapter(prefix, host)
+        mount_point = '{}/'.format(prefix)
+        if session.adapters.get(mount_point, None) is not adapter:
+            session.mount(mount_point, adapter)
+        return session
+
+    def get_breaker(self, host):
+        with self.lock:
+            breaker = self.breakers.get(host, None)
+            if breaker is None:
+                breaker = CircuitBreaker(host)
+                self.breakers[host] = breaker
+            return breaker
+
+    def request(self, method, url, **kwargs):
+        if 'timeout' not in kwargs:
+            kwargs['timeout'] = (const.HTTP_CONNECT_TIMEOUT,
+                                 const.HTTP_READ_TIMEOUT)
+        method = method.upper()
+        breaker = self.get_breaker(self._get_prefix(url)[1])
+        retries = 0
+        if method in IDEMPOTENT_METHODS:
+            retries = const.HTTP_MAX_RETRIES
+        attempt = 0
+        while True:
+            breaker.before_request()
+            res = None
+            try:
+                res = self.get_session(url).request(method, url, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                breaker.record_failure()
+                if attempt >= retries:
+                    raise e
+                # The exception's message contains the whole url.
+                core.LOGS.info('{} "{}" failed ({}), retrying'
+                               .format(method, self._get_loggable_url(url),
+                                       type(e).__name__))
+            if res is not None:
+                if res.status_code not in const.HTTP_RETRY_STATUS_CODES:
+                    breaker.record_success()
+                    return res
+                breaker.record_failure()
+                if attempt >= retries:
+                    return res
+                core.LOGS.info('{} "{}" failed (status {}), retrying'
+                               .format(method, self._get_loggable_url(url),
+                                       res.status_code))
+                res.close()
+            time.sleep(const.HTTP_RETRY_BACKOFF * (2 ** attempt) *
+                       (1 + random.random()))
+            attempt += 1
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def put(self, url, **kwargs):
+        return self.request('PUT', url, **kwargs)
+
+    # Returns, for each host, the number of requests sent, the number of
+    # connections opened and so how many times a connection has been reused.
+    def get_stats(self):
+        with self.lock:
+            adapters = dict(self.adapters)
+        stats = {}
+        for prefix, adapter in adapters.items():
+            nb_requests = 0
+            nb_connections = 0
+            pools = adapter.poolmanager.pools
+            for key in pools.keys():
+                pool = pools.get(key, None)
+                if pool is None:
+                    continue
+                nb_requests += pool.num_requests
+                nb_connections += pool.num_connections
+            stats[prefix] = {
+                'requests': nb_requests,
+                'connections': nb_connections,
+                'reused': max(nb_requests - nb_connections, 0),
+            }
+        return stats
+
+    def __str__(self):
+        stats = self.get_stats()
+        if len(stats) == 0:
+            return 'no request sent'
+        with self.lock:
+            breakers = dict(self.breakers)
+        return ', '.join(['{}: {} requests, {} connections, {} reused, '
+                          'circuit breaker {}'
+                          .format(prefix, entry['requests'],
+                                  entry['connections'], entry['reused'],
+                                  breakers[prefix.split('://')[-1]].state
+                                  if prefix.split('://')[-1] in breakers
+                                  else 'closed')
+                          for prefix, entry in sorted(stats.items())])
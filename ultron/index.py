@@ -4,8 +4,6 @@ import http.cookies
 import html
 import json
 import os
-# pip3 install requests
-import requests
 import signal
 import subprocess
 from http.server import BaseHTTPRequestHandler, HTTPServer
@@ -114,6 +112,17 @@ def make_pr_status(pr):
     return pr.status
 
 
+# Saves the changes made to the queues (by an event for example) in the
+# database.
+def save_queues():
+    if core.QUEUES is None:
+        return
+    try:
+        core.QUEUES.save_snapshot()
+    except Exception as e:
+        core.LOGS.error('save_queues failed: {}'.format(e), e)
+
+
 def make_log_type_to_css_class(log_type):
     return "err_entry" if log_type == core.LOGS.ERROR else "other_entry"
 
@@ -123,13 +132,13 @@ def get_access(code):
         core.LOGS.error('get_access failed: no code received')
         return None
     try:
-        req = requests.post('https://github.com/login/oauth/access_token',
-                            headers={'Content-type': 'application/json',
-                                     'Accept': 'application/json'},
-                            data=json.dumps(
-                                     {'client_id': core.CLIENT_ID,
-                                      'client_secret': core.CLIENT_SECRET,
-                                      'code': code}))
+        req = core.HTTP_POOL.post(
+            'https://github.com/login/oauth/access_token',
+            headers={'Content-type': 'application/json',
+                     'Accept': 'application/json'},
+            data=json.dumps({'client_id': core.CLIENT_ID,
+                             'client_secret': core.CLIENT_SECRET,
+                             'code': code}))
         return ci.get_requests_json(req)
     except Exception as ex:
         core.LOGS.error('get_access failed: {}'.format(ex))
@@ -373,6 +382,9 @@ class RequestHandler(BaseHTTPRequestHandler):
                        headers={'Content-type': 'text/{}'.format(extension)},
                        type_=type_)
 
+    # It runs on the server's thread: it can't wait as long as background
+    # requests for the rate limit to be reset.
+    @my_github.request_priority(const.GH_PRIORITY_WEBHOOK)
     def authenticate(self):
         query_components = parse_qs(urlparse(self.path).query)
         code = query_components.get('code', None)
@@ -475,9 +487,12 @@ class RequestHandler(BaseHTTPRequestHandler):
                 else:
                     github_event.handle_event(data)
             elif path.endswith("circleci"):
-                # circleCI event
-                ci.handle_ci_response(data)
-                core.COMMENT_QUEUE.flush()
+                # circleCI event. It's the one leading to merges, so its
+                # github requests go first.
+                with my_github.REQUEST_SCHEDULER.priority(
+                        const.GH_PRIORITY_MERGE):
+                    ci.handle_ci_response(data)
+                    core.COMMENT_QUEUE.flush()
             else:
                 # The next line needs to be removed! We keep it for now for
                 # compatibility.
@@ -493,6 +508,7 @@ class RequestHandler(BaseHTTPRequestHandler):
             self.end_headers()
         except Exception as ex:
             core.LOGS.error('do_POST failed: {}'.format(ex), ex)
+        save_queues()
 
     # The only thing we do when we receive a PUT request is using our
     # scheduler.
@@ -521,6 +537,7 @@ class RequestHandler(BaseHTTPRequestHandler):
         self.send_response(200)
         self.send_header("Content-type", "text/html")
         self.end_headers()
+        save_queues()
 
 
 def start():
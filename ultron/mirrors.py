@@ -0,0 +1,339 @@
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+from ultron import const
+from ultron import core
+from ultron import utils
+
+
+# A bare mirror of a github repository (pull requests' heads included), along
+# with its pool of worktrees. They're kept next to it (and not inside it, to
+# not make git look at them each time it goes through the mirror's files).
+class Mirror:
+    def __init__(self, path):
+        self.path = path
+        # Held while the mirror is created or updated, or while a worktree is
+        # added or removed (a fetch fails if it happens at the same time).
+        self.lock = threading.Lock()
+        self.size = 0
+        self.last_used = 0
+        # Number of updates since the mirror was created or loaded.
+        self.updates = 0
+        # Number of running operations using the mirror (protected by the
+        # MirrorCache lock). A mirror in use can't be removed.
+        self.users = 0
+        self.worktrees_path = get_worktrees_path(path)
+        # Worktrees which aren't leased.
+        self.free_worktrees = []
+        # Number of worktrees (leased or not).
+        self.worktrees_count = 0
+        self.worktree_id = 0
+        self.worktrees_checked = False
+        self.condition = threading.Condition()
+
+    def compute_size(self):
+        size = 0
+        for root, dirs, files in os.walk(self.path):
+            for name in files:
+                try:
+                    size += os.path.getsize(os.path.join(root, name))
+                except OSError:
+                    pass
+        self.size = size
+
+    def _exec_git(self, folder, args, logs=True):
+        command = ['git', '-C', folder] + args
+        try:
+            ret, stdout, stderr = utils.exec_command(
+                command, timeout=const.MIRROR_FETCH_TIMEOUT)
+        except subprocess.TimeoutExpired:
+            ret, stdout, stderr = False, '', 'timed out'
+        if ret is False and logs is True:
+            core.LOGS.error('Mirror: "{}" failed:\n{}'.format(
+                            ' '.join(command),
+                            utils.join_outputs(stdout, stderr)))
+        return ret
+
+    # Returns the path of a free worktree (creating it if needed), waiting for
+    # one to be released if there are already `max_count` of them. Returns
+    # None if the worktree couldn't be created.
+    def acquire_worktree(self, max_count):
+        with self.condition:
+            if self.worktrees_checked is False:
+                # Worktrees left by a previous run are in an unknown state.
+                self.worktrees_checked = True
+                shutil.rmtree(self.worktrees_path, ignore_errors=True)
+                self._exec_git(self.path, ['worktree', 'prune'])
+            while (len(self.free_worktrees) == 0 and
+                   self.worktrees_count >= max_count):
+                self.condition.wait()
+            if len(self.free_worktrees) != 0:
+                return self.free_worktrees.pop()
+            self.worktrees_count += 1
+            self.worktree_id += 1
+            path = os.path.join(self.worktrees_path, str(self.worktree_id))
+        # Always detached, so the mirror's branches can still be updated.
+        with self.lock:
+            ret = self._exec_git(self.path, ['worktree', 'add', '--detach',
+                                             '--quiet', path])
+        if ret is False:
+            self.reclaim_worktree(path)
+            return None
+        return path
+
+    # Resets the worktree so it can be used again. If it fails, the worktree
+    # is removed.
+    def release_worktree(self, path):
+        # Only fails if there is nothing to abort.
+        self._exec_git(path, ['rebase', '--abort'], logs=False)
+        self._exec_git(path, ['merge', '--abort'], logs=False)
+        if (self._exec_git(path, ['reset', '--hard', '--quiet']) is False or
+                self._exec_git(path, ['clean', '-ffdxq']) is False):
+            self.reclaim_worktree(path)
+            return
+        with self.condition:
+            self.free_worktrees.append(path)
+            self.condition.notify()
+
+    def reclaim_worktree(self, path):
+        with self.lock:
+            self._exec_git(self.path, ['worktree', 'remove', '--force',
+                                       path])
+            shutil.rmtree(path, ignore_errors=True)
+            self._exec_git(self.path, ['worktree', 'prune'])
+        with self.condition:
+            self.worktrees_count -= 1
+            self.condition.notify()
+
+
+# Directory of MirrorCache's path where the mirrors are moved before being
+# removed.
+TRASH_DIR = '.trash'
+
+
+def get_worktrees_path(mirror_path):
+    return '{}.worktrees'.format(os.path.splitext(mirror_path)[0])
+
+
+# On-disk cache of bare mirrors of the repositories, so git operations only
+# have to fetch what changed since the last time instead of cloning
+# everything again.
+#
+# Mirrors are created on first use and updated each time one of their
+# worktrees is leased. Up to `worktrees` worktrees of each mirror are kept, so
+# several PRs of a repository can be checked or merged at the same time
+# without checking out the repository every time. When their total size goes
+# over `max_size` bytes, the least recently used mirrors are removed.
+class MirrorCache:
+    def __init__(self, path=const.MIRRORS_PATH,
+                 max_size=const.MIRRORS_MAX_SIZE,
+                 worktrees=const.WORKTREES_PER_MIRROR):
+        self.path = path
+        self.max_size = max_size
+        self.worktrees = worktrees
+        # Mirror path -> Mirror.
+        self.mirrors = {}
+        self.lock = threading.Lock()
+        self.loaded = False
+
+    def configure(self, path, max_size, worktrees):
+        with self.lock:
+            if path != self.path:
+                self.path = path
+                self.mirrors = {}
+                self.loaded = False
+            self.max_size = max_size
+            self.worktrees = worktrees
+
+    # Mirrors left by a previous run count in the cache size as well.
+    def _load(self):
+        self.loaded = True
+        if not os.path.isdir(self.path):
+            return
+        # Left by a previous run.
+        shutil.rmtree(os.path.join(self.path, TRASH_DIR), ignore_errors=True)
+        for owner in os.listdir(self.path):
+            owner_path = os.path.join(self.path, owner)
+            if not os.path.isdir(owner_path):
+                continue
+            names = os.listdir(owner_path)
+            for name in names:
+                mirror_path = os.path.join(owner_path, name)
+                if name.endswith('.git') and mirror_path not in self.mirrors:
+                    mirror = Mirror(mirror_path)
+                    mirror.compute_size()
+                    mirror.last_used = os.path.getmtime(mirror_path)
+                    self.mirrors[mirror_path] = mirror
+                elif (name.endswith('.worktrees') and
+                        '{}.git'.format(name[:-10]) not in names):
+                    # Its mirror has been removed.
+                    shutil.rmtree(mirror_path, ignore_errors=True)
+
+    def _get_mirror_path(self, repo_url):
+        parts = repo_url.rstrip('/').split('/')
+        name = parts[-1]
+        if not name.endswith('.git'):
+            name = '{}.git'.format(name)
+        return os.path.abspath(os.path.join(self.path, parts[-2].lower(),
+                                            name.lower()))
+
+    def _get_mirror(self, repo_url):
+        mirror_path = self._get_mirror_path(repo_url)
+        with self.lock:
+            if self.loaded is False:
+                self._load()
+            mirror = self.mirrors.get(mirror_path, None)
+            if mirror is None:
+                mirror = Mirror(mirror_path)
+                self.mirrors[mirror_path] = mirror
+            mirror.users += 1
+            return mirror
+
+    # The token isn't stored in the mirror's configuration: the url
+    # containing it is only given to the commands which need it.
+    def _update(self, mirror, repo_url):
+        auth_url = utils.add_key_repo_url(repo_url)
+        if os.path.isdir(mirror.path):
+            mirror.updates += 1
+            commands = [(['git', '-C', mirror.path, 'fetch', '--prune',
+                          auth_url, '+refs/*:refs/*'],
+                         const.MIRROR_FETCH_TIMEOUT)]
+            # Going through all the files of the mirror takes a while so its
+            # size is only computed when it's been compacted.
+            if mirror.updates % const.MIRROR_GC_INTERVAL != 0:
+                return self._exec_commands(mirror, repo_url, commands)
+            commands.append((['git', '-C', mirror.path, 'gc', '--auto',
+                              '--quiet'], const.MIRROR_FETCH_TIMEOUT))
+        else:
+            os.makedirs(os.path.dirname(mirror.path), exist_ok=True)
+            commands = [(['git', 'clone', '--mirror', '--quiet', auth_url,
+                          mirror.path], const.MIRROR_CLONE_TIMEOUT),
+                        (['git', '-C', mirror.path, 'remote', 'set-url',
+                          'origin', repo_url], const.MIRROR_FETCH_TIMEOUT)]
+        if self._exec_commands(mirror, repo_url, commands) is False:
+            return False
+        mirror.compute_size()
+        return True
+
+    def _exec_commands(self, mirror, repo_url, commands):
+        for command, timeout in commands:
+            try:
+                ret, stdout, stderr = utils.exec_command(command,
+                                                         timeout=timeout)
+            except subprocess.TimeoutExpired:
+                ret, stdout, stderr = False, '', 'timed out'
+            if ret is False:
+                core.LOGS.error('MirrorCache: "{}" failed on {}:\n{}'.format(
+                                command[3] if command[1] == '-C'
+                                else command[1],
+                                repo_url, utils.join_outputs(stdout, stderr)))
+                if not os.path.isdir(os.path.join(mirror.path, 'refs')):
+                    # Not even a git repository, let's start again next
+                    # time.
+                    shutil.rmtree(mirror.path, ignore_errors=True)
+                return False
+        return True
+
+    # Removes the least recently used mirrors (which aren't in use) until the
+    # cache is small enough.
+    def _collect_garbage(self):
+        trash_paths = []
+        with self.lock:
+            mirrors = sorted(self.mirrors.values(),
+                             key=lambda mirror: mirror.last_used)
+            total = sum([mirror.size for mirror in mirrors])
+            for mirror in mirrors:
+                if total <= self.max_size:
+                    break
+                if mirror.users != 0:
+                    continue
+                del self.mirrors[mirror.path]
+                trash_paths.append(self._move_to_trash(mirror))
+                total -= mirror.size
+                core.LOGS.info('MirrorCache: removed "{}" ({} bytes)'
+                               .format(mirror.path, mirror.size))
+        # Removing the files takes a while, the mirrors can be used in the
+        # meantime.
+        for trash_path in trash_paths:
+            shutil.rmtree(trash_path, ignore_errors=True)
+
+    # Moves the mirror and its worktrees out of the way (which is fast), so
+    # the repository can be cloned again while they're being removed.
+    def _move_to_trash(self, mirror):
+        trash_root = os.path.join(self.path, TRASH_DIR)
+        os.makedirs(trash_root, exist_ok=True)
+        trash_path = tempfile.mkdtemp(dir=trash_root)
+        for path in [mirror.path, mirror.worktrees_path]:
+            if not os.path.exists(path):
+                continue
+            try:
+                os.rename(path, os.path.join(trash_path,
+                                             os.path.basename(path)))
+            except OSError:
+                shutil.rmtree(path, ignore_errors=True)
+        return trash_path
+
+    # Gives the up to date mirror of the repository (None if it couldn't be
+    # updated). It can't be removed until the end of the "with" block.
+    @contextmanager
+    def _lease_mirror(self, repo_url):
+        mirror = self._get_mirror(repo_url)
+        try:
+            with mirror.lock:
+                mirror.last_used = time.time()
+                ret = self._update(mirror, repo_url)
+            yield mirror if ret is True else None
+        finally:
+            with self.lock:
+                mirror.users -= 1
+            self._collect_garbage()
+
+    # Gives the path of the up to date mirror of the repository, for
+    # operations which don't need a working tree. If it couldn't be updated,
+    # None is given.
+    #
+    # Use it as follows:
+    #
+    # with core.MIRRORS.lease(repo_url) as mirror_path:
+    #     ...
+    @contextmanager
+    def lease(self, repo_url):
+        with self._lease_mirror(repo_url) as mirror:
+            yield mirror.path if mirror is not None else None
+
+    # Gives the path of a worktree of the up to date mirror of the repository
+    # with a detached HEAD. It's reset at the end of the "with" block (or
+    # removed if an exception was raised). If the mirror couldn't be updated
+    # or the worktree couldn't be created, None is given.
+    #
+    # Use it as follows:
+    #
+    # with core.MIRRORS.lease_worktree(repo_url) as worktree_path:
+    #     ...
+    @contextmanager
+    def lease_worktree(self, repo_url):
+        with self._lease_mirror(repo_url) as mirror:
+            path = None
+            if mirror is not None:
+                path = mirror.acquire_worktree(self.worktrees)
+            if path is None:
+                yield None
+                return
+            try:
+                yield path
+            except BaseException:
+                mirror.reclaim_worktree(path)
+                raise
+            mirror.release_worktree(path)
+
+    def __str__(self):
+        with self.lock:
+            return '{} mirrors, {} / {} bytes'.format(
+                len(self.mirrors),
+                sum([mirror.size for mirror in self.mirrors.values()]),
+                self.max_size)
@@ -1,8 +1,10 @@
+import asyncio
 import json
-# pip3 install grequests
-import grequests
-# pip3 install requests
-import requests
+import threading
+import time
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 
 from ultron import const
 from ultron import core
@@ -65,33 +67,185 @@ def check_res(res):
                         res.status_code, str(res.content)))
 
 
-# This function tries to get as much github data as possible by running
-# "parallel" requests.
-def get_all_contents(url, token=None, header_extras={}):
-    if 'per_page=' not in url:
-        if '?' not in url:
-            url += '?per_page=100'
-        else:
-            url += '&per_page=100'
-    headers = create_headers(token)
-    for extra in header_extras:
-        headers[extra] = header_extras[extra]
-    res = requests.get(url, headers=headers)
+# Rate limit information of a token, updated from every github answer.
+class RateLimit:
+    def __init__(self, limit, remaining, reset):
+        self.limit = limit
+        self.remaining = remaining
+        # Epoch time at which the budget will be reset.
+        self.reset = reset
+
+    def __str__(self):
+        return '{}/{} (reset in {}s)'.format(
+            self.remaining, self.limit, max(int(self.reset - time.time()), 0))
+
+
+# Keeps track of the remaining github budget (per token) and delays requests
+# which aren't important enough when it's running low, so merges don't fail
+# because a startup comment scan used up all the budget.
+#
+# The priority of a request is taken from the current thread's context (see
+# `priority` and `request_priority`) so it doesn't need to be passed down to
+# every function making github calls.
+class RequestScheduler:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.budgets = {}
+
+    def get_priority(self):
+        return getattr(self.local, 'priority', const.GH_PRIORITY_WEBHOOK)
+
+    @contextmanager
+    def priority(self, priority):
+        old_priority = getattr(self.local, 'priority', None)
+        self.local.priority = priority
+        try:
+            yield
+        finally:
+            if old_priority is None:
+                del self.local.priority
+            else:
+                self.local.priority = old_priority
+
+    # Github has a different budget for each API "resource" (REST API,
+    # graphql API...) so budgets are stored per token and per resource.
+    def update(self, token, headers):
+        resource = headers.get('X-RateLimit-Resource', 'core')
+        try:
+            budget = RateLimit(int(headers['X-RateLimit-Limit']),
+                               int(headers['X-RateLimit-Remaining']),
+                               int(headers['X-RateLimit-Reset']))
+        except Exception:
+            # No (or invalid) rate limit information, nothing to update.
+            return
+        with self.lock:
+            self.budgets[(token, resource)] = budget
+
+    def get_budget(self, token, resource='core'):
+        with self.lock:
+            return self.budgets.get((token, resource), None)
+
+    # If a request with `token` can be sent considering its priority (and how
+    # long it already waited), the budget is decremented right away (so
+    # concurrent requests don't all go through thinking there is enough
+    # budget left) and 0 is returned. Otherwise, returns how long (in seconds)
+    # to wait before trying again.
+    def take_budget(self, token, resource, priority, waited):
+        key = (token, resource)
+        reserve = const.GH_RATE_LIMIT_RESERVES.get(priority, 0)
+        max_wait = const.GH_RATE_LIMIT_MAX_WAITS.get(priority, 0)
+        with self.lock:
+            budget = self.budgets.get(key, None)
+            if budget is None:
+                return 0
+            delay = budget.reset - time.time()
+            if delay <= 0:
+                # The rate limit has been reset, we'll know the new value with
+                # the next answer.
+                del self.budgets[key]
+                return 0
+            if (budget.remaining > int(budget.limit * reserve) or
+                    waited >= max_wait):
+                budget.remaining -= 1
+                return 0
+        delay = min(delay, max_wait - waited) + 1
+        core.LOGS.info('Github rate limit is low ({}), delaying request of '
+                       'priority {} by {}s'.format(budget, priority,
+                                                   int(delay)))
+        return delay
+
+    # Blocks until a request with `token` can be sent considering the current
+    # priority.
+    def wait_for_budget(self, token, resource='core'):
+        priority = self.get_priority()
+        waited = 0
+        while True:
+            delay = self.take_budget(token, resource, priority, waited)
+            if delay == 0:
+                return
+            time.sleep(delay)
+            waited += delay
+
+    # Same as wait_for_budget but waits on the event loop, so waiting requests
+    # don't hold a thread of EXECUTOR which other requests need.
+    async def async_wait_for_budget(self, token, resource='core'):
+        priority = self.get_priority()
+        waited = 0
+        while True:
+            delay = self.take_budget(token, resource, priority, waited)
+            if delay == 0:
+                return
+            await asyncio.sleep(delay)
+            waited += delay
+
+    # Returns the token (among `tokens`) having the biggest budget left for
+    # `resource`. Tokens we don't know the budget of yet are considered as
+    # full.
+    def pick_token(self, tokens, resource='core'):
+        if len(tokens) == 1:
+            return tokens[0]
+        best = None
+        best_remaining = None
+        now = time.time()
+        with self.lock:
+            for token in tokens:
+                budget = self.budgets.get((token, resource), None)
+                if budget is None or budget.reset <= now:
+                    return token
+                if best is None or budget.remaining > best_remaining:
+                    best = token
+                    best_remaining = budget.remaining
+        return best
+
+    def __str__(self):
+        with self.lock:
+            if len(self.budgets) == 0:
+                return 'unknown'
+            return ', '.join(['{} ({}): {}'.format(
+                                'token ...{}'.format(key[0][-4:])
+                                if key[0] is not None else 'anonymous',
+                                key[1], budget)
+                              for key, budget in self.budgets.items()])
+
+
+REQUEST_SCHEDULER = RequestScheduler()
+
+
+# Decorator setting the priority of all github requests made in the
+# decorated function.
+def request_priority(priority):
+    def sub_wrapper(func):
+        def wrapper(*args, **kwargs):
+            with REQUEST_SCHEDULER.priority(priority):
+                return func(*args, **kwargs)
+        return wrapper
+    return sub_wrapper
+
+
+# Returns the content of a response and its "Link" header. If github
+# answered "304 Not Modified", the cached version is returned instead.
+def read_page(res, token, cache_key, cached):
+    REQUEST_SCHEDULER.update(token, res.headers)
+    if res.status_code == 304 and cached is not None:
+        core.RESPONSE_CACHE.hit()
+        return cached.get_content(), cached.link
     check_res(res)
     content = res.json()
-    if 'Link' not in res.headers:
-        # If there are no other pages, we can return the current content.
-        return content
-    # There are other pages we need to get. To do it faster, we run "parallel"
-    # requests.
     link = res.headers.get('Link', '')
-    if link is None or len(link) < 1:
-        return content
+    core.RESPONSE_CACHE.store(cache_key, res.headers, content, link)
+    return content, link
+
 
+# Returns the urls of all the pages following the first one from its "Link"
+# header.
+def get_other_pages_urls(link):
+    if link is None or len(link) < 1:
+        return []
     next_page_url, last_page_url = get_next_pages_url(link)
     # 19 is a number which matches the length of "https://github.com/"
     if len(last_page_url) < 19 or len(next_page_url) < 19:
-        return content
+        return []
     next_page = get_page_number(next_page_url)
     last_page = get_page_number(last_page_url)
 
@@ -104,73 +258,333 @@ def get_all_contents(url, token=None, header_extras={}):
                                  .replace("?{}".format(to_replace),
                                           "?page={}".format(next_page)))
         next_page += 1
-    rs = (grequests.get(u, headers=headers) for u in urls)
-    ret = grequests.map(rs)
-    # Once we got all responses, we add them to content and then return it.
-    for entry in ret:
-        entry.raise_for_status()
-        content.extend(entry.json())
+    return urls
+
+
+def make_get_headers(url, token, header_extras):
+    if 'per_page=' not in url:
+        if '?' not in url:
+            url += '?per_page=100'
+        else:
+            url += '&per_page=100'
+    headers = create_headers(token)
+    for extra in header_extras:
+        headers[extra] = header_extras[extra]
+    return url, headers
+
+
+#
+# asyncio github client.
+#
+# requests being blocking, the requests themselves are run in a thread pool
+# (whose threads all share the connections of core.HTTP_POOL). asyncio is used
+# to drive them: it allows to fetch many resources at once with a bounded
+# concurrency and a timeout on each request, without gevent's monkeypatching
+# (which doesn't mix well with the watchdog and scheduler threads).
+#
+# Every `async_*` function has a synchronous counterpart (without the prefix)
+# which runs it into its own event loop. Don't call the synchronous ones from
+# inside a running event loop.
+#
+
+# Only runs the HTTP requests themselves: nothing waiting for something else
+# (like the rate limit) should run in it.
+EXECUTOR = ThreadPoolExecutor(max_workers=const.GH_MAX_CONCURRENT_REQUESTS)
+# One semaphore per event loop.
+SEMAPHORES = weakref.WeakKeyDictionary()
+
+
+def get_semaphore(loop):
+    semaphore = SEMAPHORES.get(loop, None)
+    if semaphore is None:
+        semaphore = asyncio.BoundedSemaphore(
+            const.GH_MAX_CONCURRENT_REQUESTS)
+        SEMAPHORES[loop] = semaphore
+    return semaphore
+
+
+# Runs the given coroutine into a new event loop and returns its result.
+def run(coroutine):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        loop.close()
+
+
+# Runs all given coroutines at once and returns their results (in the same
+# order). If `return_exceptions` is True, a failing coroutine has its
+# exception returned instead of raising it.
+def gather(coroutines, return_exceptions=False):
+    async def _gather():
+        return await asyncio.gather(*coroutines,
+                                    return_exceptions=return_exceptions)
+    return run(_gather())
+
+
+async def async_request(method, url, token, resource='core', **kwargs):
+    loop = asyncio.get_event_loop()
+
+    def _request():
+        return core.HTTP_POOL.request(method, url, **kwargs)
+    # Waiting for the rate limit isn't part of the request's timeout and
+    # doesn't hold a request slot.
+    await REQUEST_SCHEDULER.async_wait_for_budget(token, resource)
+    async with get_semaphore(loop):
+        try:
+            return await asyncio.wait_for(
+                loop.run_in_executor(EXECUTOR, _request),
+                const.GH_REQUEST_TIMEOUT)
+        except asyncio.TimeoutError:
+            raise Exception('Request to "{}" timed out'.format(url))
+
+
+async def async_get_page(url, token, headers):
+    cache_key = core.RESPONSE_CACHE.make_key(url, headers)
+    cached = core.RESPONSE_CACHE.get(cache_key)
+    res = await async_request(
+        'GET', url, token,
+        headers=core.RESPONSE_CACHE.conditional_headers(headers, cached))
+    return read_page(res, token, cache_key, cached)
+
+
+# This function tries to get as much github data as possible by fetching all
+# pages at once. Pages are appended in order as soon as they're available
+# while the following ones are still being fetched.
+async def async_get_all_contents(url, token=None, header_extras={}):
+    url, headers = make_get_headers(url, token, header_extras)
+    content, link = await async_get_page(url, token, headers)
+    urls = get_other_pages_urls(link)
+    if len(urls) == 0:
+        # If there are no other pages, we can return the current content.
+        return content
+    tasks = [asyncio.ensure_future(async_get_page(u, token, headers))
+             for u in urls]
+    try:
+        for task in tasks:
+            content.extend((await task)[0])
+    finally:
+        # If one page failed, no need to wait for the other ones.
+        for task in tasks:
+            task.cancel()
     return content
 
 
+def get_all_contents(url, token=None, header_extras={}):
+    return run(async_get_all_contents(url, token, header_extras))
+
+
 def post_content(url, token, details, method='post', header_extras={}):
     headers = create_headers(token)
     for extra in header_extras:
         headers[extra] = header_extras[extra]
-    if method == 'post':
-        requests.post(url, data=json.dumps(details),
-                      headers=headers).raise_for_status()
-    else:
-        requests.put(url, data=json.dumps(details),
-                     headers=headers).raise_for_status()
+    REQUEST_SCHEDULER.wait_for_budget(token)
+    res = core.HTTP_POOL.request('POST' if method == 'post' else 'PUT', url,
+                                 data=json.dumps(details), headers=headers)
+    REQUEST_SCHEDULER.update(token, res.headers)
+    res.raise_for_status()
 
 
 # The point of this function is to try to improve a bit the github rate
 # limit. Not sure if this is really useful...
-def try_without_token(url):
+#
+# Returns None if the rate limit has been reached or if the resource can't be
+# accessed without token (a private repository for example).
+async def async_try_without_token(url):
     try:
-        return get_all_contents(url)
+        return await async_get_all_contents(url)
     except Exception as e:
-        if 'Github rate limit exceeded...' not in str(e):
+        if ('Github rate limit exceeded...' not in str(e) and
+                'Get request failed, got: [404]' not in str(e)):
             raise e
     return None
 
 
+def try_without_token(url):
+    return run(async_try_without_token(url))
+
+
+# Remembers, for each repository and each kind of request ('pulls', 'pull'...),
+# if the last one could be done without token. If it couldn't, the token is
+# used directly (instead of paying for a failing unauthenticated request
+# first) until the unauthenticated rate limit is reset.
+class RouteLearner:
+    def __init__(self):
+        self.lock = threading.Lock()
+        # (repository, kind) -> time until which the token has to be used.
+        self.token_routes = {}
+
+    def should_try_without_token(self, repo, kind):
+        key = (repo, kind)
+        with self.lock:
+            until = self.token_routes.get(key, None)
+            if until is None:
+                return True
+            if until > time.time():
+                return False
+            # Time to check again.
+            del self.token_routes[key]
+            return True
+
+    def learn(self, repo, kind, without_token):
+        key = (repo, kind)
+        if without_token:
+            with self.lock:
+                self.token_routes.pop(key, None)
+            return
+        now = time.time()
+        budget = REQUEST_SCHEDULER.get_budget(None)
+        if budget is not None and budget.reset > now:
+            until = budget.reset
+        else:
+            until = now + const.GH_ROUTE_RELEARN_DELAY
+        with self.lock:
+            self.token_routes[key] = until
+
+
+ROUTE_LEARNER = RouteLearner()
+
+
+# Gets all the content of `url` without token if it's possible and if it
+# worked the last time for this kind of request on `repo`, with its token
+# otherwise.
+async def async_get_from_repo(repo, kind, url):
+    repo_key = '{}/{}'.format(repo.owner, repo.name)
+    if (not repo.is_private and
+            ROUTE_LEARNER.should_try_without_token(repo_key, kind)):
+        content = await async_try_without_token(url)
+        ROUTE_LEARNER.learn(repo_key, kind, content is not None)
+        if content is not None:
+            return content
+    return await async_get_all_contents(url,
+                                        token=repo.gh_object.get_read_token())
+
+
+async def async_graphql(query, variables, token):
+    res = await async_request('POST', const.GH_GRAPHQL_URL, token,
+                              resource='graphql',
+                              headers=create_headers(token),
+                              data=json.dumps({'query': query,
+                                               'variables': variables}))
+    REQUEST_SCHEDULER.update(token, res.headers)
+    check_res(res)
+    data = res.json()
+    if len(data.get('errors', None) or []) > 0:
+        raise Exception('Graphql request failed: {}'.format(
+                        ', '.join([str(error.get('message', error))
+                                   for error in data['errors']])))
+    return data['data']
+
+
+# Gets open pull requests of a repository with their last comments and their
+# number of commits. Used by Repository.hydrate_pulls.
+HYDRATE_PULLS_QUERY = """
+query($owner: String!, $name: String!, $count: Int!, $cursor: String) {
+  repository(owner: $owner, name: $name) {
+    pullRequests(states: OPEN, first: $count, after: $cursor) {
+      pageInfo { hasNextPage endCursor }
+      nodes {
+        number
+        title
+        baseRefName
+        headRefName
+        headRefOid
+        author { login }
+        headRepository { name url isPrivate owner { login } }
+        commits { totalCount }
+        comments(last: 100) {
+          pageInfo { hasPreviousPage }
+          nodes { databaseId author { login } body }
+        }
+      }
+    }
+  }
+}
+"""
+
+
+def _get_login(node):
+    # Deleted accounts are returned as null by the graphql API.
+    if node is None or node.get('author', None) is None:
+        return 'ghost'
+    return node['author']['login']
+
+
+# Returns None if the repository the PR comes from has been deleted: like with
+# the REST API, such PRs are ignored.
+def _create_hydrated_pull(gh_object, node, target_repo):
+    head = node.get('headRepository', None)
+    if head is None:
+        core.LOGS.info('_create_hydrated_pull: ignoring {}/{}#{}, its head '
+                       'repository has been deleted'.format(
+                        target_repo.owner, target_repo.name, node['number']))
+        return None
+    from_repo = get_repository(gh_object, head['name'],
+                               head['owner']['login'], head['url'],
+                               head['isPrivate'])
+    nb_commits = node['commits']['totalCount']
+    if nb_commits < 1:
+        nb_commits = 250  # to be sure to include all commits
+    # Like the REST pulls list, we don't know if it's mergeable.
+    pr = PullRequest(gh_object, target_repo, from_repo, node['number'],
+                     node['baseRefName'], node['headRefName'],
+                     node['headRefOid'], node['title'], _get_login(node),
+                     'null', nb_commits)
+    # If there are more comments than the ones we got, we let the caller
+    # fetch them.
+    comments = node['comments']
+    if comments['pageInfo']['hasPreviousPage'] is False:
+        pr.preloaded_comments = [Comment(_get_login(comment),
+                                         comment['body'], pr.number,
+                                         comment['databaseId'])
+                                 for comment in comments['nodes']]
+    return pr
+
+
 # Global Github class. If you need to make a Github api request, use it or
 # one of the classes below.
+#
+# `token` is the bot identity: it's used for everything which writes on
+# github (comments, review dismissals...). Read requests are spread over
+# `read_tokens` (which should contain `token` as well), based on the budget
+# left of each of them.
 class Github:
-    def __init__(self, token):
+    def __init__(self, token, read_tokens=None):
         self.token = token
+        if read_tokens is None or len(read_tokens) == 0:
+            read_tokens = [token]
+        self.read_tokens = list(read_tokens)
+
+    def get_read_token(self, resource='core'):
+        return REQUEST_SCHEDULER.pick_token(self.read_tokens, resource)
 
     def get_organization(self, organization_name):
         # get_all_contents raises an Exception if something fails, so no need
         # to check the returned value.
         get_all_contents('{}/orgs/{}'.format(
                          const.GH_API_URL, organization_name),
-                         token=self.token)
+                         token=self.get_read_token())
         return Organization(self, organization_name)
 
-    def get_pull(self, repo_name, repo_owner, html_url, is_private,
-                 pull_number):
-        return Repository(self, repo_name, repo_owner, html_url,
-                          is_private).get_pull(pull_number)
+    def get_pull(self, repo_name, repo_owner, pull_number):
+        return get_repository(self, repo_name,
+                              repo_owner).get_pull(pull_number)
 
     def create_pull(self, pr):
-        target_repo_name = pr['base']['repo']['name']
-        target_repo_owner = pr['base']['repo']['owner']['login']
-        target_repo_url = pr['base']['repo']['html_url']
-        return _create_pull(self, pr, Repository(self,
-                                                 target_repo_name,
-                                                 target_repo_owner,
-                                                 target_repo_url,
-                                                 True))
+        target_repo = pr['base']['repo']
+        return _create_pull(self, pr, get_repository(self,
+                                                     target_repo['name'],
+                                                     target_repo['owner']
+                                                     ['login'],
+                                                     target_repo['html_url'],
+                                                     target_repo['private']))
 
     def get_repo(self, repo_name, repo_owner):
         r = get_all_contents('{}/repos/{}/{}'.format(
                              const.GH_API_URL, repo_owner, repo_name),
-                             token=self.token)
-        return Repository(self, repo_name, repo_owner, r['html_url'],
-                          r["private"])
+                             token=self.get_read_token())
+        return get_repository(self, repo_name, repo_owner, r['html_url'],
+                              r["private"])
 
     def get_repo_branch(self, branch_name, repo_name, repo_owner):
         # get_all_contents raises an Exception if something fails, so no need
@@ -178,21 +592,27 @@ class Github:
         get_all_contents('{}/repos/{}/{}/branches/{}'
                          .format(const.GH_API_URL, repo_owner, repo_name,
                                  branch_name),
-                         token=self.token)
+                         token=self.get_read_token())
         return Branch(branch_name, repo_name, repo_owner)
 
-    def get_commits_from_pull(self, repo_name, repo_owner, pr_number):
-        commits = get_all_contents('{}/repos/{}/{}/pulls'
-                                   '/{}/commits'
-                                   .format(const.GH_API_URL, repo_owner,
-                                           repo_name, pr_number),
-                                   token=self.token)
+    async def async_get_commits_from_pull(self, repo_name, repo_owner,
+                                          pr_number):
+        commits = await async_get_all_contents('{}/repos/{}/{}/pulls'
+                                               '/{}/commits'
+                                               .format(const.GH_API_URL,
+                                                       repo_owner, repo_name,
+                                                       pr_number),
+                                               token=self.get_read_token())
         return [Commit(commit['commit']['author']['name'],
                        commit['commit']['committer']['name'],
                        commit['commit']['message'],
                        commit['sha'])
                 for commit in commits]
 
+    def get_commits_from_pull(self, repo_name, repo_owner, pr_number):
+        return run(self.async_get_commits_from_pull(repo_name, repo_owner,
+                                                    pr_number))
+
 
 # Represents a Github organization,
 class Organization:
@@ -203,18 +623,18 @@ class Organization:
     def get_repos(self):
         repos = get_all_contents('{}/orgs/{}/repos'
                                  .format(const.GH_API_URL, self.name),
-                                 token=self.gh_object.token)
-        return [Repository(self.gh_object,
-                           repo['name'],
-                           self.name,
-                           repo['html_url'],
-                           repo['private']) for repo in repos]
+                                 token=self.gh_object.get_read_token())
+        return [get_repository(self.gh_object,
+                               repo['name'],
+                               self.name,
+                               repo['html_url'],
+                               repo['private']) for repo in repos]
 
     def get_repo(self, repo_name):
         return core.GITHUB.get_repo(repo_name, self.name)
 
 
-def _create_pull(gh_object, pr, target_repo):
+async def _async_create_pull(gh_object, pr, target_repo):
     nb_commits = None
     if 'commits' in pr:
         try:
@@ -224,7 +644,7 @@ def _create_pull(gh_object, pr, target_repo):
             core.LOGS.error('_create_pull: int("{}") failed'
                             .format(pr['commits']), ex)
     if nb_commits is None:
-        nb_commits = len(gh_object.get_commits_from_pull(
+        nb_commits = len(await gh_object.async_get_commits_from_pull(
             target_repo.get_name(),
             target_repo.get_owner(),
             pr['number']))
@@ -233,11 +653,11 @@ def _create_pull(gh_object, pr, target_repo):
     if nb_commits < 1:
         nb_commits = 250  # to be sure to include all commits
     return PullRequest(gh_object, target_repo,
-                       Repository(gh_object,
-                                  pr['head']['repo']['name'],
-                                  pr['head']['repo']['owner']['login'],
-                                  pr['head']['repo']['html_url'],
-                                  target_repo.is_private),
+                       get_repository(gh_object,
+                                      pr['head']['repo']['name'],
+                                      pr['head']['repo']['owner']['login'],
+                                      pr['head']['repo']['html_url'],
+                                      pr['head']['repo']['private']),
                        pr['number'],
                        pr['base']['ref'],
                        pr['head']['ref'],
@@ -249,8 +669,17 @@ def _create_pull(gh_object, pr, target_repo):
                        pr['state'] == 'open')
 
 
+def _create_pull(gh_object, pr, target_repo):
+    return run(_async_create_pull(gh_object, pr, target_repo))
+
+
 # Represents a Github repository.
+#
+# Use get_repository to get one: PRs of a same repository share it.
 class Repository:
+    __slots__ = ('name', 'gh_object', 'owner', 'html_url', 'is_private',
+                 '__weakref__')
+
     def __init__(self, gh_object, name, owner, html_url, is_private):
         self.name = name
         self.gh_object = gh_object
@@ -258,36 +687,64 @@ class Repository:
         self.html_url = html_url
         self.is_private = is_private
 
-    def get_pulls(self):
-        prs = None
-        if not self.is_private:
-            prs = try_without_token('{}/repos/{}/{}/pulls'
-                                    .format(const.GH_API_URL, self.owner,
-                                            self.name))
-        if prs is None:
-            prs = get_all_contents('{}/repos/{}/{}/pulls'
-                                   .format(const.GH_API_URL, self.owner,
-                                           self.name),
-                                   token=self.gh_object.token)
+    async def async_get_pulls(self):
+        prs = await async_get_from_repo(self, 'pulls',
+                                        '{}/repos/{}/{}/pulls'
+                                        .format(const.GH_API_URL, self.owner,
+                                                self.name))
         if prs is None:
             return []
-        return [_create_pull(self.gh_object, pr, self) for pr in prs]
+        # The pulls list doesn't give the number of commits of each PR so we
+        # get them all at once.
+        return await asyncio.gather(*[_async_create_pull(self.gh_object, pr,
+                                                         self)
+                                      for pr in prs])
 
-    def get_pull(self, pull_number):
-        pr = None
-        if not self.is_private:
-            pr = try_without_token('{}/repos/{}/{}/'
-                                   'pulls/{}'.format(
-                                    const.GH_API_URL, self.owner, self.name,
-                                    pull_number))
-        if pr is None:
-            pr = get_all_contents('{}/repos/{}/{}/pulls/{}'
-                                  .format(const.GH_API_URL, self.owner,
-                                          self.name, pull_number),
-                                  token=self.gh_object.token)
+    def get_pulls(self):
+        return run(self.async_get_pulls())
+
+    # Bulk version of get_pulls: open pull requests are fetched along with
+    # their comments and number of commits through the graphql API, which
+    # only takes one request per const.GH_GRAPHQL_PAGE_SIZE pull requests. If
+    # a pull request has too many comments to be fetched this way, its
+    # `preloaded_comments` is left to None.
+    async def async_hydrate_pulls(self):
+        pulls = []
+        cursor = None
+        while True:
+            data = await async_graphql(HYDRATE_PULLS_QUERY,
+                                       {'owner': self.owner,
+                                        'name': self.name,
+                                        'count': const.GH_GRAPHQL_PAGE_SIZE,
+                                        'cursor': cursor},
+                                       self.gh_object.get_read_token(
+                                           'graphql'))
+            if data.get('repository', None) is None:
+                raise Exception('Repository "{}/{}" not found'.format(
+                                self.owner, self.name))
+            prs = data['repository']['pullRequests']
+            for node in prs['nodes']:
+                pr = _create_hydrated_pull(self.gh_object, node, self)
+                if pr is not None:
+                    pulls.append(pr)
+            if prs['pageInfo']['hasNextPage'] is not True:
+                return pulls
+            cursor = prs['pageInfo']['endCursor']
+
+    def hydrate_pulls(self):
+        return run(self.async_hydrate_pulls())
+
+    async def async_get_pull(self, pull_number):
+        pr = await async_get_from_repo(self, 'pull',
+                                       '{}/repos/{}/{}/pulls/{}'
+                                       .format(const.GH_API_URL, self.owner,
+                                               self.name, pull_number))
         if pr is None:
             return None
-        return _create_pull(self.gh_object, pr, self)
+        return await _async_create_pull(self.gh_object, pr, self)
+
+    def get_pull(self, pull_number):
+        return run(self.async_get_pull(pull_number))
 
     def get_branch(self, branch_name):
         return core.GITHUB.get_repo_branch(branch_name, self.name, self.owner)
@@ -303,8 +760,42 @@ class Repository:
         return self.owner
 
 
+# Repositories currently in use, by github object, owner and name.
+REPOSITORIES = weakref.WeakValueDictionary()
+REPOSITORIES_LOCK = threading.Lock()
+
+
+# Returns the Repository already in use if any, or a new one.
+#
+# `html_url` and `is_private` come from github: if the caller doesn't know
+# them, they're left to None and the ones of the Repository already in use
+# are kept (when there is none, they're guessed from the name and the
+# repository is considered private so its token is always used).
+def get_repository(gh_object, name, owner, html_url=None, is_private=None):
+    key = (gh_object, owner.lower(), name.lower())
+    with REPOSITORIES_LOCK:
+        repo = REPOSITORIES.get(key, None)
+        if repo is None:
+            if html_url is None:
+                html_url = '{}/{}/{}'.format(const.GH_URL, owner, name)
+            repo = Repository(gh_object, name, owner, html_url,
+                              is_private is not False)
+            REPOSITORIES[key] = repo
+        else:
+            if html_url is not None:
+                repo.html_url = html_url
+            if is_private is not None:
+                repo.is_private = is_private
+        return repo
+
+
 # Represents a Github Pull Request.
 class PullRequest:
+    __slots__ = ('target_repo', 'gh_object', 'number', 'target_branch',
+                 'from_branch', 'head_commit', 'title', 'author', 'is_open',
+                 'from_repo', 'mergeable', 'number_of_commits',
+                 'preloaded_comments')
+
     def __init__(self, gh_object, target_repo, from_repo,
                  pull_number, target_branch, from_branch, head_commit,
                  title, author, mergeable, number_of_commits,
@@ -323,16 +814,47 @@ class PullRequest:
         # 'null' means github hasn't computed it yet
         self.mergeable = mergeable
         self.number_of_commits = number_of_commits
+        # Filled by Repository.hydrate_pulls. It represents what github
+        # returned at this moment, so don't use it afterwards.
+        self.preloaded_comments = None
 
-    def get_comments(self):
-        comments = get_all_contents(
+    async def async_get_comments(self):
+        comments = await async_get_all_contents(
             '{}/repos/{}/{}/issues/{}/comments'
             .format(const.GH_API_URL, self.target_repo.get_owner(),
                     self.target_repo.get_name(), self.number),
-            token=self.gh_object.token)
-        return [Comment(comment['user']['login'], comment['body'], self.number)
+            token=self.gh_object.get_read_token())
+        return [Comment(comment['user']['login'], comment['body'], self.number,
+                        comment['id'])
                 for comment in comments]
 
+    def get_comments(self):
+        return run(self.async_get_comments())
+
+    # Asynchronous generator returning comments from the newest to the
+    # oldest. Pages are only fetched when needed, so stopping the iteration
+    # early avoids getting (and parsing) the oldest ones.
+    #
+    # github returns comments from the oldest to the newest and doesn't allow
+    # to change this order on this endpoint, so we need the first page to
+    # know how many there are.
+    async def async_iter_comments_newest_first(self):
+        token = self.gh_object.get_read_token()
+        url, headers = make_get_headers(
+            '{}/repos/{}/{}/issues/{}/comments'
+            .format(const.GH_API_URL, self.target_repo.get_owner(),
+                    self.target_repo.get_name(), self.number),
+            token, {})
+        first_page, link = await async_get_page(url, token, headers)
+        for page_url in reversed(get_other_pages_urls(link)):
+            page = (await async_get_page(page_url, token, headers))[0]
+            for comment in reversed(page):
+                yield Comment(comment['user']['login'], comment['body'],
+                              self.number, comment['id'])
+        for comment in reversed(first_page):
+            yield Comment(comment['user']['login'], comment['body'],
+                          self.number, comment['id'])
+
     # Doesn't create a code comment, so be careful and know the difference!
     def create_issue_comment(self, message):
         post_content('{}/repos/{}/{}/issues/{}/comments'
@@ -370,7 +892,7 @@ class PullRequest:
             '{}/repos/{}/{}/pulls/{}/reviews'
             .format(const.GH_API_URL, self.target_repo.get_owner(),
                     self.target_repo.get_name(), self.number),
-            token=self.gh_object.token,
+            token=self.gh_object.get_read_token(),
             # TODO: This header should be removed once the github API has been
             #       stabilized!!!
             header_extras={'Accept':
@@ -424,10 +946,12 @@ class Review:
 #
 # PS: issue comment != (review comment || code comment)
 class Comment:
-    def __init__(self, author, message, pr_number):
+    def __init__(self, author, message, pr_number, _id=None):
         self.author = author
         self.message = message
         self.pr_number = pr_number
+        # Comments' ids are increasing.
+        self.id = _id
 
 
 class User:
@@ -1,5 +1,6 @@
 import datetime
 import sys
+import threading
 import traceback
 
 from ultron import const
@@ -16,18 +17,21 @@ class Logs:
         self.OTHER = 1
         self.current_id = 0
         self.ids = []
+        # Logs can be written from multiple threads (at startup for example).
+        self.lock = threading.Lock()
 
     def _append(self, kind, msg):
         current_time = _get_current_time()
-        new_id = '{}-{}'.format(current_time, self.current_id)
-        self.logs[new_id] = [kind, current_time, msg]
-        self.ids.append(new_id)
-        self.current_id += 1
-        if self.current_id >= const.MAX_LOGS:
-            self.current_id = 0
-        if len(self.ids) > const.MAX_LOGS:
-            _id = self.ids.pop(0)
-            del self.logs[_id]
+        with self.lock:
+            new_id = '{}-{}'.format(current_time, self.current_id)
+            self.logs[new_id] = [kind, current_time, msg]
+            self.ids.append(new_id)
+            self.current_id += 1
+            if self.current_id >= const.MAX_LOGS:
+                self.current_id = 0
+            if len(self.ids) > const.MAX_LOGS:
+                _id = self.ids.pop(0)
+                del self.logs[_id]
 
     def error(self, msg, exception=None):
         if exception is not None:
@@ -39,21 +39,6 @@ def _parse_priority(parts, pull, queue):
     return ParseStatus(ret, command=command)
 
 
-def all_url_check(pull, url_to_check):
-    if len(url_to_check) != 0:
-        url = url_to_check
-        try:
-            url = utils.transform_github_url(url, pull.get_url())
-            if url is None:
-                return (False, url_to_check,
-                        'Invalid PR url: "{}"'.format(url_to_check))
-            utils.check_github_url(url)
-        except Exception as e:
-            return (False, url_to_check, '"{}": {}'.format(url, e))
-        return (True, url, '')
-    return (True, '', '')
-
-
 @arguments_inspector
 def _parse_after(parts, pull, queue, last_r):
     if '[' in parts[1]:
@@ -67,22 +52,19 @@ def _parse_after(parts, pull, queue, last_r):
             last_r['prs_to_check'] = l
             return ParseStatus(True, command=parts[0])
         return queue_mod.check_after_urls(l, pull)
-    command = '{}={}'.format(parts[0], parts[1])
-    status, url, message = all_url_check(pull, parts[1])
-    if status is False:
-        return ParseStatus(False, command=command, message=message)
-    if len(url) > 0:
-        if last_r is not None:
-            # no need to check, we just want the last array
-            last_r['prs_to_check'] = [url]
-            return ParseStatus(True, command=command)
-        pull.afters = [url]
-    else:
+    if len(parts[1]) > 0:
+        # Checked like the "[...]" arguments.
         if last_r is not None:
             # no need to check, we just want the last array
-            last_r['prs_to_check'] = []
+            last_r['prs_to_check'] = [parts[1]]
+            return ParseStatus(True, command=parts[0])
         pull.afters = []
-    return ParseStatus(True, command=command)
+        return queue_mod.check_after_urls([parts[1]], pull)
+    if last_r is not None:
+        # no need to check, we just want the last array
+        last_r['prs_to_check'] = []
+    pull.afters = []
+    return ParseStatus(True, command='{}='.format(parts[0]))
 
 
 @arguments_inspector
@@ -114,10 +96,9 @@ def _parse_env_var(parts, pull):
                            message="An environment variable name cannot be "
                                    "empty!")
     if len(parts[1]) < 1:
-        if parts[0] in pull.env_args:
-            del pull.env_args[parts[0]]
+        pull.set_env_arg(parts[0], None)
     else:
-        pull.env_args[parts[0]] = parts[1]
+        pull.set_env_arg(parts[0], parts[1])
     return ParseStatus(True, command="{}={}".format(parts[0], parts[1]))
 
 
@@ -293,6 +274,11 @@ def r_plus_command(cmd, pull, queue):
                            message='SHA "{}" has been removed, PR is still '
                                    '__approved__.'.format(old_sha))
     elif pull.status == const.PENDING:
+        if pull.batch is not None:
+            return ParseStatus(False,
+                               command=cmd,
+                               message='The PR is already being tested at '
+                                       '"{}".'.format(pull.batch.ci_url))
         ci_status = ci.get_ci_status(pull.repo_name(), pull.repo_owner(),
                                      pull.try_ci_url)
         if ci_status == 'running':
@@ -438,6 +424,18 @@ def parse_commands(poster, no_dup, queue, pull, workflow, last_r):
     return ParseStatus.from_list(results)
 
 
+# Returns the name of all the commands given to Ultron in the comment (so
+# 'p' for 'p=1', 'r' for 'r=hash', etc...) without running them.
+def get_commands_name(comment):
+    names = set()
+    for part in comment.split('@{}'.format(core.USERNAME))[1:]:
+        for arg in part.split():
+            if arg == ':':
+                continue
+            names.add(arg.split('=')[0])
+    return names
+
+
 # This function does multiple things in this order:
 #
 # * Check if Ultron has been summoned.
@@ -2,12 +2,18 @@
 # 'my_github.py' to interact with github so classes' names here are very
 # close to 'my_github.py' ones. Please keep in mind that this file represents
 # Ultron's queue whereas 'my_github.py' represents Github's view.
-import copy
+import heapq
 import json
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
+from ultron import batch
 from ultron import ci
 from ultron import const
 from ultron import core
+from ultron import my_github
 from ultron import parse
 from ultron import scheduler
 from ultron import utils
@@ -21,53 +27,244 @@ if 'get_ci_status' not in dir(ci):
     ci = reload(ci)
 
 
+# Converts a priority value (a number or const.ROLLUP) into an integer which
+# can be compared with the other ones.
+def get_priority_key(priority):
+    if priority.__class__ is Priority:
+        return priority.cmp_priority
+    if priority == const.ROLLUP:
+        return -1
+    return int(priority)
+
+
 # Class used to make PRQueueItem's priority handling more easy and intuitive.
+#
+# Comparisons are done on the integer key only, whatever the other value is
+# (a Priority, a number or const.ROLLUP).
 class Priority:
+    __slots__ = ('priority', 'cmp_priority')
+
     def __init__(self, priority=0):
         self.priority = priority
-        self.cmp_priority = self._convert()
+        self.cmp_priority = get_priority_key(priority)
 
     def update(self, new_priority):
         self.priority = new_priority
-        self.cmp_priority = self._convert()
-
-    def _convert(self):
-        if self.priority == const.ROLLUP:
-            return -1
-        return int(self.priority)
+        self.cmp_priority = get_priority_key(new_priority)
 
     def __str__(self):
         return str(self.priority)
 
     def __lt__(self, other):
-        if other.__class__.__name__ != 'Priority':
-            return self < Priority(other)
-        return self.cmp_priority < other.cmp_priority
+        return self.cmp_priority < get_priority_key(other)
 
     def __le__(self, other):
-        if other.__class__.__name__ != 'Priority':
-            return self <= Priority(other)
-        return self.cmp_priority <= other.cmp_priority
+        return self.cmp_priority <= get_priority_key(other)
 
     def __gt__(self, other):
-        if other.__class__.__name__ != 'Priority':
-            return self > Priority(other)
-        return self.cmp_priority > other.cmp_priority
+        return self.cmp_priority > get_priority_key(other)
 
     def __ge__(self, other):
-        if other.__class__.__name__ != 'Priority':
-            return self >= Priority(other)
-        return self.cmp_priority >= other.cmp_priority
+        return self.cmp_priority >= get_priority_key(other)
 
     def __eq__(self, other):
-        if other.__class__.__name__ != 'Priority':
-            return self.priority == other
-        return self.cmp_priority == other.cmp_priority
+        try:
+            return self.cmp_priority == get_priority_key(other)
+        except (TypeError, ValueError):
+            return False
 
     def __ne__(self, other):
-        if other.__class__.__name__ == 'Priority':
-            return self.priority != other
-        return self.cmp_priority != other.cmp_priority
+        return not self == other
+
+    def __hash__(self):
+        return hash(self.cmp_priority)
+
+
+# Gives the PR (and which of its builds) a CI build url corresponds to, so
+# CI notifications don't require to go through all the queues.
+#
+# Builds can be found by their url or by their number (along with the owner
+# and name of the tested project, as given by circleCI notifications). It's
+# kept up to date by PRQueueItem itself, when its `ci_url` or `try_ci_url` are
+# changed.
+class BuildIndex:
+    def __init__(self):
+        # Queues are filled from multiple threads at startup.
+        self.lock = threading.Lock()
+        # url -> (PRQueueItem, kind), kind being 'ci_url' or 'try_ci_url'.
+        self.builds = {}
+        # (owner, project, build number) -> url
+        self.numbers = {}
+
+    def _make_url_key(self, build_url):
+        build_url = build_url.split('://')[-1].rstrip('/')
+        return build_url.lower()
+
+    def _make_number_key(self, build_url):
+        parts = self._make_url_key(build_url).split('/')
+        if len(parts) < 3:
+            return None
+        try:
+            return (parts[-3], parts[-2], int(parts[-1]))
+        except Exception:
+            return None
+
+    def add(self, build_url, pr, kind):
+        key = self._make_url_key(build_url)
+        number_key = self._make_number_key(build_url)
+        with self.lock:
+            self.builds[key] = (pr, kind)
+            if number_key is not None:
+                self.numbers[number_key] = key
+
+    def remove(self, build_url, pr):
+        key = self._make_url_key(build_url)
+        number_key = self._make_number_key(build_url)
+        with self.lock:
+            entry = self.builds.get(key, None)
+            if entry is None or entry[0] is not pr:
+                return
+            del self.builds[key]
+            if number_key is not None and self.numbers.get(number_key) == key:
+                del self.numbers[number_key]
+
+    # Returns the PRQueueItem and the kind of the build ('ci_url' or
+    # 'try_ci_url'), or (None, None) if the build is unknown.
+    def get(self, build_url, owner=None, project=None, build_num=None):
+        with self.lock:
+            entry = self.builds.get(self._make_url_key(build_url), None)
+            if entry is None and build_num is not None:
+                key = self.numbers.get(
+                    (str(owner).lower(), str(project).lower(), build_num),
+                    None)
+                if key is not None:
+                    entry = self.builds.get(key, None)
+        if entry is None:
+            return None, None
+        return entry
+
+
+# Graph of the after= dependencies of all the queued PRs (the children) on
+# other PRs (their parents), whatever their repository.
+#
+# It also stores whether parents are open or not. For parents of watched
+# repositories, this state is updated from github events (and from our own
+# merges), so when a parent gets merged or closed, its children which were
+# only waiting for it are moved to pending right away. Parents from other
+# repositories don't send us events, so their state isn't kept and has to be
+# checked again.
+class DependencyGraph:
+    def __init__(self):
+        # Queues are filled from multiple threads at startup.
+        self.lock = threading.RLock()
+        # child url -> set of parent urls
+        self.parents = {}
+        # parent url -> set of child urls
+        self.children = {}
+        # child url -> PRQueueItem
+        self.items = {}
+        # parent url -> True if open, False otherwise
+        self.states = {}
+
+    def _make_key(self, url):
+        return url.rstrip('/').lower()
+
+    # Returns True if we get github events for the repository of the given
+    # PR url.
+    def is_watched(self, url):
+        parts = self._make_key(url).split('/')
+        if len(parts) < 5 or core.QUEUES is None:
+            return False
+        return (parts[3] == core.ORGANIZATION.lower() and
+                parts[4] in [name.lower() for name in core.QUEUES.repos])
+
+    def set_parents(self, pr, afters):
+        with self.lock:
+            self._set_parents(pr, afters)
+
+    def _set_parents(self, pr, afters):
+        child = self._make_key(pr.get_url())
+        registered = self.items.get(child, None)
+        if (len(afters) == 0 and registered is not None and
+                registered is not pr):
+            # Another item of the same PR (the queued one) is registered, this
+            # one (just created for example) has nothing to remove.
+            return
+        for parent in self.parents.pop(child, set()):
+            children = self.children.get(parent, set())
+            children.discard(child)
+            if len(children) == 0:
+                self.children.pop(parent, None)
+                self.states.pop(parent, None)
+        if len(afters) == 0:
+            self.items.pop(child, None)
+            return
+        self.items[child] = pr
+        self.parents[child] = set([self._make_key(after) for after in afters])
+        for parent in self.parents[child]:
+            self.children.setdefault(parent, set()).add(child)
+
+    def remove(self, pr):
+        if self.items.get(self._make_key(pr.get_url()), None) is pr:
+            self.set_parents(pr, [])
+
+    # Returns True if `pr` depending on `url` would create a dependency
+    # cycle.
+    def would_create_cycle(self, pr, url):
+        child = self._make_key(pr.get_url())
+        to_check = [self._make_key(url)]
+        checked = set()
+        with self.lock:
+            while len(to_check) > 0:
+                current = to_check.pop()
+                if current == child:
+                    return True
+                if current in checked:
+                    continue
+                checked.add(current)
+                to_check.extend(self.parents.get(current, set()))
+        return False
+
+    # Returns True if the parent is open, False if not and None if we don't
+    # know.
+    def get_state(self, url):
+        return self.states.get(self._make_key(url), None)
+
+    # Only stores the state of watched parents which have children: we can't
+    # know when the other ones change.
+    def set_state(self, url, is_open):
+        key = self._make_key(url)
+        with self.lock:
+            if key in self.children and self.is_watched(url):
+                self.states[key] = is_open
+
+    # To be called when a PR is opened, reopened, closed or merged. If none of
+    # the other parents of some children is known to be open anymore, their
+    # queues are updated: the parents whose state we don't know (not checked
+    # yet or not watched) are checked again by PRQueue.check_afters.
+    def update_parent(self, url, is_open):
+        key = self._make_key(url)
+        if key not in self.children:
+            return
+        self.set_state(url, is_open)
+        if is_open is True:
+            return
+        repos = set()
+        with self.lock:
+            for child in self.children.get(key, set()):
+                pr = self.items.get(child, None)
+                if pr is None or pr.status != const.APPROVED:
+                    continue
+                if not any([self.states.get(parent, None) is True
+                            for parent in self.parents.get(child, set())]):
+                    repos.add(pr.repo_name())
+                    repo = core.QUEUES.repos.get(pr.repo_name(), None)
+                    if repo is not None:
+                        repo.q.mark_branch_dirty(pr)
+        for repo_name in repos:
+            repo = core.QUEUES.repos.get(repo_name, None)
+            if repo is not None:
+                repo.update_next_to_pending()
 
 
 # Represents a PullRequest inside a queue.
@@ -75,8 +272,15 @@ class Priority:
 # For more comfort, most of the needed my_github.PullRequest variable have
 # a method in here to get them.
 class PRQueueItem:
+    __slots__ = ('pr', '_ci_url', '_try_ci_url', 'priority', '_afters',
+                 'status', 'needed_review', 'reviews', '_env_args',
+                 '_own_env_args', 'sha', 'last_error', 'batch',
+                 'approval_order', 'last_comment_id')
+
     def __init__(self, priority, afters, status, pr,
                  ci_url='', env_args={}, sha=None):
+        # It is my_github.PullRequest class.
+        self.pr = pr
         # Represents the pending build's url. If it succeeds, PR gets merged.
         self.ci_url = ci_url
         # Represents the "try" build's url. If it succeeds, it just prints the
@@ -97,8 +301,6 @@ class PRQueueItem:
         # * 'failed'       : If the pending build failed, it gets this status.
         # * 'not mergeable': If the PR isn't mergeable.
         self.status = status
-        # It is my_github.PullRequest class.
-        self.pr = pr
         # Not implemented for now.
         #
         # 0 means that the review needed system is disabled.
@@ -108,13 +310,20 @@ class PRQueueItem:
         # Represents the number of approval for a PR.
         self.reviews = 0
         # Represents the environment arguments.
-        self.env_args = copy.deepcopy(env_args)
+        self.env_args = env_args
         # Commit from which the PR should be merged.
         self.sha = sha
         if self.sha is not None and sha == "":
             self.sha = None
         # Last error displayed to avoid giving out the same information twice
         self.last_error = None
+        # The batch.Batch the PR is being tested in (if any).
+        self.batch = None
+        # Approval order, kept when the PR goes back from pending to approved
+        # so it doesn't lose its place.
+        self.approval_order = None
+        # Id of the last comment of the PR we read.
+        self.last_comment_id = 0
 
     # not very useful on its own but it provides an equivalent of:
     # `pr = new_pr` (but instead we use `.update()`)
@@ -127,8 +336,71 @@ class PRQueueItem:
         self.pr = other.pr
         self.needed_review = other.needed_review
         self.reviews = other.reviews
-        self.env_args = copy.deepcopy(other.env_args)
+        self.env_args = other.env_args
         self.sha = other.sha
+        self.batch = other.batch
+        self.approval_order = other.approval_order
+        self.last_comment_id = other.last_comment_id
+
+    def _set_build_url(self, kind, build_url):
+        old_url = getattr(self, '_{}'.format(kind), None)
+        if old_url == build_url:
+            return
+        if old_url is not None and len(old_url) > 0:
+            core.BUILD_INDEX.remove(old_url, self)
+        setattr(self, '_{}'.format(kind), build_url)
+        if len(build_url) > 0:
+            core.BUILD_INDEX.add(build_url, self, kind)
+
+    # Environment arguments are shared with the ones they come from (another
+    # PRQueueItem for example) until they're modified, so don't modify them in
+    # place: use set_env_arg.
+    @property
+    def env_args(self):
+        return self._env_args
+
+    @env_args.setter
+    def env_args(self, env_args):
+        self._env_args = env_args
+        self._own_env_args = False
+
+    # Removes the environment argument if `value` is None.
+    def set_env_arg(self, name, value):
+        if self._own_env_args is False:
+            self._env_args = dict(self._env_args)
+            self._own_env_args = True
+        if value is None:
+            self._env_args.pop(name, None)
+        else:
+            self._env_args[name] = value
+
+    # Dependencies are kept in core.DEPENDENCIES as well, so don't modify
+    # the list in place.
+    @property
+    def afters(self):
+        return self._afters
+
+    @afters.setter
+    def afters(self, afters):
+        self._afters = afters
+        core.DEPENDENCIES.set_parents(self, afters)
+
+    # Builds' urls are kept in core.BUILD_INDEX as well.
+    @property
+    def ci_url(self):
+        return self._ci_url
+
+    @ci_url.setter
+    def ci_url(self, ci_url):
+        self._set_build_url('ci_url', ci_url)
+
+    @property
+    def try_ci_url(self):
+        return self._try_ci_url
+
+    @try_ci_url.setter
+    def try_ci_url(self, try_ci_url):
+        self._set_build_url('try_ci_url', try_ci_url)
 
     def number(self):
         return self.pr.number
@@ -186,7 +458,7 @@ class PRQueueItem:
 
     def get_github_pr(self):
         return core.GITHUB.get_pull(self.repo_name(), self.repo_owner(),
-                                    self.get_url(), True, self.number())
+                                    self.number())
 
     def set_last_error(self, last_error):
         self.last_error = last_error
@@ -195,14 +467,11 @@ class PRQueueItem:
         return (err_msg is not None and len(err_msg) > 0 and
                 self.last_error != err_msg)
 
+    # Returns True if one of the dependencies is in a repository we don't
+    # get events from.
     def has_external_after(self):
-        if core.QUEUES is None:
-            return False
         for after in self.afters:
-            for queue in core.QUEUES:
-                repo_url = core.QUEUES.repos[queue['name']].get_url()
-                if after.startswith(repo_url):
-                    continue
+            if not core.DEPENDENCIES.is_watched(after):
                 return True
         return False
 
@@ -212,31 +481,51 @@ class PRQueueItem:
 
 
 # An iterator utility to loop through PRQueue.
+#
+# It loops through a snapshot of the queue so PRs can change of status (and
+# so of container) while iterating.
 class PRIterator:
     def __init__(self, prs):
-        self.prs = prs
+        self.prs = [pr for container in prs for pr in container]
         self.current = 0
-        self.sub_current = 0
 
     def __next__(self):
-        if len(self.prs) < 1:
-            raise StopIteration
-        while (self.current < len(self.prs) and
-               self.sub_current >= len(self.prs[self.current])):
-            self.sub_current = 0
-            self.current += 1
         if self.current >= len(self.prs):
             raise StopIteration
-        self.sub_current += 1
-        return self.prs[self.current][self.sub_current - 1]
+        self.current += 1
+        return self.prs[self.current - 1]
+
+
+# Insertion-ordered container of PRQueueItem, indexed by PR number so checking
+# if a PR is in it or removing it doesn't require to go through all of them.
+class PRList:
+    def __init__(self):
+        self.prs = OrderedDict()
+
+    def append(self, pr):
+        self.prs[pr.number()] = pr
+
+    def remove(self, pr):
+        del self.prs[pr.number()]
+
+    def get(self, pr_number):
+        return self.prs.get(pr_number, None)
+
+    def __contains__(self, pr_number):
+        return pr_number in self.prs
+
+    def __len__(self):
+        return len(self.prs)
+
+    # Like PRIterator, it loops through a snapshot.
+    def __iter__(self):
+        return iter(list(self.prs.values()))
 
 
 # Check if all dependencies have been merged/closed.
 #
-# TODO: It's possible that someone enters a cyclic after thing. Might be nice
-# and useful to check it.
-# However it's possible that they might want a cyclic stuff in order to block
-# the queue.
+# Dependencies which would create a cycle are refused: the PRs in the cycle
+# would never be tested.
 def check_after_urls(urls_to_check, pull):
     ret = []
     for url in urls_to_check:
@@ -251,9 +540,15 @@ def check_after_urls(urls_to_check, pull):
                                    command=url,
                                    message="'{}': duplicate".format(new_url)))
             continue
+        if core.DEPENDENCIES.would_create_cycle(pull, new_url):
+            ret.append(ParseStatus(False,
+                                   command=url,
+                                   message="'{}': would create a dependency "
+                                           "cycle".format(new_url)))
+            continue
         try:
             utils.check_github_url(new_url)
-            pull.afters.append(new_url)
+            pull.afters = pull.afters + [new_url]
             ret.append(ParseStatus(True, command=url))
         except Exception as e:
             ret.append(ParseStatus(False,
@@ -262,6 +557,97 @@ def check_after_urls(urls_to_check, pull):
     return ParseStatus.from_list(ret, 'after')
 
 
+# Approved PRs, sorted by testing order in one heap per target branch.
+#
+# The testing order is:
+#
+# * the higher priority first.
+# * for a same priority, PRs with dependencies first (they must block PRs of
+#   the same priority level).
+# * then the first approved first.
+# * rollup PRs are always last (without taking their dependencies into
+#   account).
+#
+# Removed PRs are only marked as such and dropped from the heap once they
+# reach its top (or when there are too many of them).
+class ApprovedPRs:
+    def __init__(self):
+        # Target branch -> heap of entries.
+        self.heaps = {}
+        # Target branch -> number of PRs (not removed) in its heap.
+        self.sizes = {}
+        # PR number -> [priority, dependencies, order, insertion, branch,
+        # PRQueueItem]. The insertion counter ensures that two entries of a
+        # same PR never compare equal.
+        self.entries = {}
+        self.counter = 0
+
+    def _make_entry(self, pr):
+        self.counter += 1
+        if pr.approval_order is None:
+            pr.approval_order = self.counter
+        priority = pr.priority.cmp_priority
+        has_afters = (not pr.priority == const.ROLLUP and
+                      len(pr.afters) > 0)
+        return [-priority, 0 if has_afters else 1, pr.approval_order,
+                self.counter, pr.target_branch(), pr]
+
+    def append(self, pr):
+        if pr.number() in self.entries:
+            self.remove(pr)
+        entry = self._make_entry(pr)
+        self.entries[pr.number()] = entry
+        heapq.heappush(self.heaps.setdefault(entry[4], []), entry)
+        self.sizes[entry[4]] = self.sizes.get(entry[4], 0) + 1
+
+    def remove(self, pr):
+        entry = self.entries.pop(pr.number())
+        entry[-1] = None
+        branch = entry[4]
+        self.sizes[branch] -= 1
+        heap = self.heaps[branch]
+        if len(heap) > 2 * self.sizes[branch] + 16:
+            heap = [entry for entry in heap if entry[-1] is not None]
+            heapq.heapify(heap)
+            self.heaps[branch] = heap
+
+    # Returns the first PR to be tested on `branch` (or None).
+    def get_next(self, branch):
+        heap = self.heaps.get(branch, None)
+        if heap is None:
+            return None
+        while len(heap) > 0 and heap[0][-1] is None:
+            heapq.heappop(heap)
+        if len(heap) == 0:
+            del self.heaps[branch]
+            del self.sizes[branch]
+            return None
+        return heap[0][-1]
+
+    # Returns the PRs of `branch` in testing order (only the first `limit`
+    # ones if set).
+    def get_branch_prs(self, branch, limit=None):
+        entries = [entry for entry in self.heaps.get(branch, [])
+                   if entry[-1] is not None]
+        if limit is not None:
+            entries = heapq.nsmallest(limit, entries)
+        else:
+            entries.sort()
+        return [entry[-1] for entry in entries]
+
+    def __contains__(self, pr_number):
+        return pr_number in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    # Loops through a snapshot of all approved PRs, in testing order.
+    def __iter__(self):
+        return iter([entry[-1] for entry in
+                     sorted(self.entries.values(),
+                            key=lambda entry: entry[:4])])
+
+
 # corresponds to PRQueue.all_prs
 EQS = {
     const.PENDING: 0,
@@ -278,43 +664,64 @@ EQS = {
 # stuff...).
 class PRQueue:
     def __init__(self):
-        self.pending_prs = []
-        self.failed_prs = []
-        self.not_mergeable_prs = []
-        self.approved_prs = []
-        self.other_prs = []
+        # PR number -> PRQueueItem, whatever its status.
+        self.prs = {}
+        # Head commit sha -> PRQueueItem, used to know which PR a push
+        # updated.
+        self.heads = {}
+        # Numbers of the PRs which changed (or have been removed) since the
+        # last time the queue has been saved in the database.
+        self.dirty = set()
+        self.removed = set()
+        # Target branches whose next PR to test might have changed. Only them
+        # are looked at by update_next_to_pending.
+        self.dirty_branches = set()
+        # Target branches whose next PR waits for something we won't be told
+        # about (dependencies from other repositories, errors): the scheduler
+        # marks them as dirty again later.
+        self.waiting_branches = set()
+        self.updating_pendings = False
+        # Target branch -> batch.Batch being tested.
+        self.batches = {}
+        # Target branch -> batch.Batch list of its merge train, each one
+        # being tested on top of the ones before it.
+        self.trains = {}
+        # Set by QueueRepository.
+        self.workflow = None
+        # Target branch -> list of (kind, PR numbers) which have to be tested
+        # (in this order) to find which PR made a batch fail.
+        self.bisections = {}
+        # Target branch -> outcomes of its last PRs tested in batches.
+        self.batch_history = {}
+        self.pending_prs = PRList()
+        self.failed_prs = PRList()
+        self.not_mergeable_prs = PRList()
+        self.approved_prs = ApprovedPRs()
+        self.other_prs = PRList()
         self.all_prs = [self.pending_prs, self.failed_prs,
                         self.not_mergeable_prs, self.approved_prs,
                         self.other_prs]
 
-    # TODO: when there is only rollup PRs in the approved queue, we could try
-    # merging all at once.
-    #
     # No check is done in this method, be careful (the point is to be fast).
     def add_pr(self, pr):
-        if pr.status == const.APPROVED:
-            if pr.priority == const.ROLLUP:
-                self.approved_prs.append(pr)
-                return
-            i = 0
-            # We add the new approved PR at the end of the approved queue.
-            while i < len(self.approved_prs):
-                if self.approved_prs[i].priority < pr.priority:
-                    break
-                i += 1
-            # However, if the PR has dependency, it must block other PRs of the
-            # same of lower priority level.
-            if len(pr.afters) > 0:
-                while (i > 0
-                       and self.approved_prs[i - 1].priority == pr.priority
-                       and len(self.approved_prs[i - 1].afters) < 1):
-                    i -= 1
-            if i >= len(self.approved_prs):
-                self.approved_prs.append(pr)
-            else:
-                self.approved_prs.insert(i, pr)
-        else:
-            self.all_prs[EQS[pr.status]].append(pr)
+        # Keeps the index consistent if the PR was already in the queue.
+        old_pr = self.get_pr(pr.number())
+        if old_pr is not None:
+            self._remove_pr(old_pr)
+        self.prs[pr.number()] = pr
+        self.heads[pr.head_commit()] = pr
+        self.mark_dirty(pr)
+        self.mark_branch_dirty(pr)
+        # Approved PRs are sorted by ApprovedPRs.
+        self.all_prs[EQS[pr.status]].append(pr)
+
+    # Removes the PR from the queue. It must be in it!
+    def _remove_pr(self, pr):
+        self.mark_branch_dirty(pr)
+        self.all_prs[EQS[pr.status]].remove(pr)
+        del self.prs[pr.number()]
+        if self.heads.get(pr.head_commit(), None) is pr:
+            del self.heads[pr.head_commit()]
 
     # Update a PRQueueItem with another's values.
     def update_pr_values(self, updated_pr):
@@ -322,58 +729,105 @@ class PRQueue:
             core.LOGS.error('Unknown PR status: "{}"'.format(
                                       updated_pr.status))
             return
-        # I can't use self.get_pr here because I need more information than it
-        # provides.
-        for elem in self.all_prs:
-            i = 0
-            for pr in elem:
-                if pr.number() == updated_pr.number():
-                    self._update_pr_values(elem, updated_pr, i)
-                    return
-                i += 1
-        # The PR doesn't exist, we add it.
-        self.add_pr(updated_pr)
-
-    def _update_pr_values(self, pr_list, updated_pr, pos):
-        pr_list.pop(pos)
+        pr = self.get_pr(updated_pr.number())
+        if pr is None:
+            # The PR doesn't exist, we add it.
+            self.add_pr(updated_pr)
+            return
+        self._remove_pr(pr)
         if updated_pr.is_merged:
             return
         self.add_pr(updated_pr)
 
     def get_pr(self, pr_number):
-        for prs in self.all_prs:
-            for pr in prs:
-                if pr.number() == pr_number:
-                    return pr
-        return None
+        return self.prs.get(pr_number, None)
+
+    def mark_dirty(self, pr):
+        self.dirty.add(pr.number())
+        self.removed.discard(pr.number())
+
+    # Only approved and pending PRs have an impact on what's tested next.
+    def mark_branch_dirty(self, pr):
+        if pr.status == const.APPROVED or pr.status == const.PENDING:
+            self.dirty_branches.add(pr.target_branch())
+
+    def has_pending_on_branch(self, branch):
+        for pull in self.pending_prs:
+            if pull.target_branch() == branch:
+                return True
+        return False
+
+    # Saves the PRs which changed since the last call in the database.
+    def save_snapshot(self, repo_name):
+        entries = []
+        for number in self.dirty:
+            pr = self.get_pr(number)
+            if pr is None:
+                continue
+            entries.append({
+                'repo_name': repo_name,
+                'number': number,
+                'priority': pr.priority,
+                'afters': pr.afters,
+                'env_args': pr.env_args,
+                'status': pr.status,
+                'sha': pr.sha,
+                'last_error': pr.last_error,
+                'last_comment_id': pr.last_comment_id,
+            })
+        removed = [(repo_name, number) for number in self.removed]
+        if core.DB.save_queue_snapshot(entries, removed):
+            self.dirty = set()
+            self.removed = set()
+
+    def get_pr_from_head_commit(self, head_commit):
+        return self.heads.get(head_commit, None)
+
+    # To be called when new commits have been pushed on the PR.
+    def update_head_commit(self, pr, head_commit):
+        if self.heads.get(pr.head_commit(), None) is pr:
+            del self.heads[pr.head_commit()]
+        pr._get_pr().head_commit = head_commit
+        self.heads[head_commit] = pr
 
     def _check_afters(self, pr):
+        ret, msg = self.check_afters(pr)
+        if ret is False:
+            return (ret, msg)
+        if self.update_status(pr, const.PENDING) is False:
+            return (False, "Couldn't update to pending")
+        return (True, "")
+
+    # Returns (True, "") if all the dependencies of the PR have been merged.
+    def check_afters(self, pr):
         if len(pr.afters) != 0:
             for after in pr.afters:
                 try:
-                    other = utils.check_github_url(after)
-                    if other is not None and other.is_open is True:
+                    is_open = core.DEPENDENCIES.get_state(after)
+                    if is_open is None:
+                        other = utils.check_github_url(after)
+                        is_open = other is not None and other.is_open is True
+                        core.DEPENDENCIES.set_state(after, is_open)
+                    if is_open is True:
                         # Since the "parent" PR is open, we can't do anything.
                         return (False, "One dependency hasn't been merged yet")
                 except Exception as e:
                     core.LOGS.error('try_update_to_pending error: {}'
                                     .format(e), e)
+                    self.wait_for_scheduler(pr)
                     return (False,
                             "Unexpected error occurred. Take a look to the "
                             "logs")
-        if self.update_status(pr, const.PENDING) is False:
-            return (False, "Couldn't update to pending")
         return (True, "")
 
     def _pre_checks(self, pr):
         if pr.status != const.APPROVED:
             return (False, "Pull request isn't approved")
         # First, we check if there is already a pending pr on the same branch.
-        for pull in self.pending_prs:
-            if pr.target_branch() == pull.target_branch():
-                return (False,
-                        "There is already a pending pull request on "
-                        "the same branch")
+        if self.has_pending_on_branch(pr.target_branch()):
+            return (False,
+                    "There is already a pending pull request on the same "
+                    "branch")
         ret, msg = self.is_next_on_branch(pr)
         if ret is False:
             return (ret, msg)
@@ -389,7 +843,10 @@ class PRQueue:
         return self._check_afters(pr)
 
     def try_update_to_pending(self, pr, insert_db=True):
-        status, message = self._pre_checks(pr)
+        # This is the path leading to CI builds and merges so its github
+        # requests must not be delayed by less important ones.
+        with my_github.REQUEST_SCHEDULER.priority(const.GH_PRIORITY_MERGE):
+            status, message = self._pre_checks(pr)
         if status is False:
             return (False, message)
         ci_url, comment = ci.trigger_ci_build(pr.env_args,
@@ -419,31 +876,98 @@ class PRQueue:
 
     def is_next_on_branch(self, pr):
         # Check if the pr is the first in the approved queue.
-        for pull in self.approved_prs:
-            if pull.target_branch() == pr.target_branch():
-                if pull.number() != pr.number():
-                    return (False,
-                            "Another pull requests (#{}) has a higher priority"
-                            .format(pull.number))
-                return (True, "")
-        return (False, "The pull request hasn't been found...")
+        pull = self.approved_prs.get_next(pr.target_branch())
+        if pull is None:
+            return (False, "The pull request hasn't been found...")
+        if pull.number() != pr.number():
+            return (False,
+                    "Another pull requests (#{}) has a higher priority"
+                    .format(pull.number()))
+        return (True, "")
 
+    # Only the dirty branches are computed again, so calling it many times in
+    # a row (or while it's running) is cheap. A branch marked as dirty while
+    # being updated (because its next PR isn't mergeable for example) is
+    # updated again.
     def update_next_to_pending(self):
-        # TODO: A potential improvement could be to stop once every branch has
-        #       a pending PR. To see later.
-        for pr in self.approved_prs:
-            is_next_on_branch = self.is_next_on_branch(pr)[0]
-            ret, err_msg = self.try_update_to_pending(pr)
-            if ret is False:
-                if is_next_on_branch is True:
-                    if pr.can_print_message(err_msg):
-                        core.COMMENT_QUEUE.append(
-                            utils.create_comment(pr, err_msg))
-                        pr.set_last_error(err_msg)
-                    if pr.has_external_after() is True:
-                        core.SCHEDULER.add(
-                            scheduler.ScheduleInfo(
-                                scheduler.try_update_pendings))
+        if self.updating_pendings is True:
+            return
+        self.updating_pendings = True
+        try:
+            while len(self.dirty_branches) != 0:
+                branch = min(self.dirty_branches)
+                self.dirty_branches.discard(branch)
+                self._update_branch_to_pending(branch)
+        finally:
+            self.updating_pendings = False
+
+    # The PR's branch will be updated again by the scheduler. It isn't marked
+    # as dirty right away, otherwise update_next_to_pending would never stop.
+    def wait_for_scheduler(self, pr):
+        self.waiting_branches.add(pr.target_branch())
+        core.SCHEDULER.add(
+            scheduler.ScheduleInfo(
+                scheduler.try_update_pendings))
+
+    def update_waiting_branches(self):
+        self.dirty_branches.update(self.waiting_branches)
+        self.waiting_branches = set()
+        self.update_next_to_pending()
+
+    def get_merge_train_depth(self, branch):
+        if self.workflow is None:
+            return 1
+        return self.workflow.get_merge_train_depth(branch)
+
+    def get_batch_size(self, branch):
+        if self.workflow is None:
+            return 1
+        return batch.get_batch_size(self, branch,
+                                    self.workflow.get_batch_size(branch))
+
+    def _update_branch_to_pending(self, branch):
+        if self.get_merge_train_depth(branch) > 1:
+            batch.update_train(self, branch,
+                               self.get_merge_train_depth(branch))
+            return
+        # The end of its build will make the branch dirty again.
+        if self.has_pending_on_branch(branch):
+            return
+        if batch.start_next_bisection(self, branch):
+            return
+        # Only the first PR of each branch can be tested so no need to check
+        # the other ones.
+        pr = self.approved_prs.get_next(branch)
+        if pr is None:
+            return
+        if pr.priority == const.ROLLUP:
+            # Only rollup PRs are left so they can be merged all at once.
+            rollups = batch.get_rollup_prs(self, branch)
+            if len(rollups) > 1 and batch.start_batch(self, const.ROLLUP,
+                                                      rollups):
+                return
+            if pr.status != const.APPROVED:
+                return
+        elif self.get_batch_size(branch) > 1:
+            prs = batch.get_batch_prs(self, branch,
+                                      self.get_batch_size(branch))
+            if len(prs) > 1 and batch.start_batch(self, 'batch', prs):
+                return
+            if pr.status != const.APPROVED:
+                return
+        ret, err_msg = self.try_update_to_pending(pr)
+        if ret is False:
+            self.report_pending_error(pr, err_msg)
+
+    # Called when the next PR of its branch couldn't be tested.
+    def report_pending_error(self, pr, err_msg):
+        if pr.can_print_message(err_msg):
+            core.COMMENT_QUEUE.append(
+                utils.create_comment(pr, err_msg))
+            pr.set_last_error(err_msg)
+        if pr.has_external_after() is True:
+            # We won't be told when its dependencies are merged.
+            self.wait_for_scheduler(pr)
 
     def update_status(self, pr, new_status):
         if pr is None:
@@ -453,21 +977,22 @@ class PRQueue:
             return False
         if new_status == pr.status:
             return True
+        if pr.batch is not None and new_status != const.PENDING:
+            # The other PRs of the batch have to be tested again.
+            batch.abort_batch(self, pr.batch)
         if new_status != const.APPROVED and new_status != const.PENDING:
             pr.sha = None
-        pos = 0
-        found = False
-        for _pr in self.all_prs[EQS[pr.status]]:
-            if _pr.number() == pr.number():
-                self.all_prs[EQS[pr.status]].pop(pos)
-                found = True
-                break
-            pos += 1
+        current = self.get_pr(pr.number())
+        found = current is not None and current.status == pr.status
         if found is True:
+            self._remove_pr(current)
             if pr.status == const.PENDING:
                 ci.cancel_ci_build(pr.repo_name(), pr.ci_url)
                 core.DB.delete_pending_pr(pr.repo_name(), pr.number())
                 pr.ci_url = ''
+            elif new_status == const.APPROVED:
+                # Newly approved, it goes after the other ones.
+                pr.approval_order = None
             pr.update_status(new_status)
             self.add_pr(pr)
         return found
@@ -482,15 +1007,14 @@ class PRQueue:
             # No need to update
             return True
         pr.priority.update(new_priority)
-        pos = 0
-        for _pr in self.all_prs[EQS[pr.status]]:
-            if _pr.number() == pr.number():
-                self.all_prs[EQS[pr.status]].pop(pos)
-                self.add_pr(pr)
-                return True
-            pos += 1
-        # PR not found? What the hell?!
-        return False
+        self.mark_dirty(pr)
+        current = self.get_pr(pr.number())
+        if current is None or current.status != pr.status:
+            # PR not found? What the hell?!
+            return False
+        self._remove_pr(current)
+        self.add_pr(pr)
+        return True
 
     def parse_comment(self, poster, pull, comment, workflow,
                       last_r=None):
@@ -511,40 +1035,47 @@ class PRQueue:
         return True
 
     def remove_closed(self, pr_number):
-        for prs in self.all_prs:
-            pos = 0
-            for pr in prs:
-                if pr.number() == pr_number:
-                    prs.pop(pos)
-                    return True
-                pos += 1
-        return False
+        pr = self.get_pr(pr_number)
+        if pr is None:
+            return False
+        if pr.batch is not None:
+            batch.abort_batch(self, pr.batch)
+        self._remove_pr(pr)
+        self.dirty.discard(pr_number)
+        self.removed.add(pr_number)
+        core.DEPENDENCIES.remove(pr)
+        # Its builds don't matter anymore.
+        for build_url in [pr.ci_url, pr.try_ci_url]:
+            if len(build_url) > 0:
+                core.BUILD_INDEX.remove(build_url, pr)
+        return True
 
     # In here, the returned value doesn't indicate if a PR has been updated
     # but if the queue needs to be computed again.
     def update_pr(self, pr_number, title, target_branch, old_target_branch,
                   default_branch, number_of_commits):
-        for prs in self.all_prs:
-            for pr in prs:
-                if pr.number() == pr_number:
-                    if pr.title() != title:
-                        pr._get_pr().title = title
-                    pr._get_pr().number_of_commits = number_of_commits
-                    if (pr.target_branch() != target_branch or
-                            old_target_branch == target_branch):
-                        # github doesn't return the new targetted branch
-                        # when the new target is the default branch it seems...
-                        if old_target_branch == target_branch:
-                            pr._get_pr().target_branch = default_branch
-                        else:
-                            pr._get_pr().target_branch = target_branch
-                        # We do this to be sure the PR will be moved according
-                        # to its new target branch.
-                        if pr.status == '':
-                            self.update_status(pr, const.FAILED)
-                        self.update_status(pr, '')
-                        return True
-                    break
+        pr = self.get_pr(pr_number)
+        if pr is None:
+            return False
+        if pr.title() != title:
+            pr._get_pr().title = title
+        pr._get_pr().number_of_commits = number_of_commits
+        if (pr.target_branch() != target_branch or
+                old_target_branch == target_branch):
+            # The old branch might have lost its next PR.
+            self.mark_branch_dirty(pr)
+            # github doesn't return the new targetted branch when the new
+            # target is the default branch it seems...
+            if old_target_branch == target_branch:
+                pr._get_pr().target_branch = default_branch
+            else:
+                pr._get_pr().target_branch = target_branch
+            # We do this to be sure the PR will be moved according to its new
+            # target branch.
+            if pr.status == '':
+                self.update_status(pr, const.FAILED)
+            self.update_status(pr, '')
+            return True
         return False
 
     def merge_pr(self, pr):
@@ -553,12 +1084,7 @@ class PRQueue:
                             'pending.'.format(pr.repo_name(),
                                               pr.number()))
             return (False, 'This pull request isn\'t pending')
-        found = False
-        for _pr in self.pending_prs:
-            if _pr.number() == pr.number():
-                found = True
-                break
-        if found is False:
+        if pr.number() not in self.pending_prs:
             core.LOGS.error('merge_pr failed: PR {}/#{} not in this '
                             'queue.'.format(pr.repo_name(),
                                             pr.number()))
@@ -569,6 +1095,8 @@ class PRQueue:
             return (ret, stdout)
         self.remove_closed(pr.number())
         core.DB.delete_pending_pr(pr.repo_name(), pr.number())
+        # No need to wait for github to tell us.
+        core.DEPENDENCIES.update_parent(pr.get_url(), False)
         return (True, None)
 
     def __iter__(self):
@@ -598,6 +1126,7 @@ class QueueRepository:
         self.repo = repo
         self.q = q
         self.workflow = workflow
+        self.q.workflow = workflow
 
     def __iter__(self):
         return PRIterator(self.q.all_prs)
@@ -622,29 +1151,47 @@ class QueueRepository:
     def update_next_to_pending(self):
         return self.q.update_next_to_pending()
 
+    def update_waiting_branches(self):
+        return self.q.update_waiting_branches()
+
     def get_pr_from_head_commit(self, head_commit):
-        for pr in self:
-            if pr.head_commit() == head_commit:
-                return pr
-        return None
+        return self.q.get_pr_from_head_commit(head_commit)
+
+    def update_head_commit(self, pr_number, head_commit):
+        pr = self.get_pr(pr_number)
+        if pr is not None and pr.head_commit() != head_commit:
+            self.q.update_head_commit(pr, head_commit)
 
     def merge_pr(self, pr):
         return self.q.merge_pr(pr)
 
-    def parse_comment(self, pr_number, poster, comment):
+    def handle_batch_result(self, tested_batch, outcome, message):
+        batch.handle_batch_result(self.q, tested_batch, outcome, message)
+
+    # Used to compute the size of the batches of the PR's branch.
+    def add_test_outcome(self, pr, success):
+        batch.add_to_history(self.q, pr.target_branch(), success)
+
+    def parse_comment(self, pr_number, poster, comment, comment_id=None):
         pull = self.get_pr(pr_number)
         if pull is None:
             core.LOGS.error('Unknown PR: {}/#{}'.format(
                             self.repo.name, pr_number))
             return
         self.q.parse_comment(poster, pull, comment, self.workflow)
-        if pull.status == const.APPROVED:
-            self.q.try_update_to_pending(pull)
+        if comment_id is not None:
+            pull.last_comment_id = max(pull.last_comment_id, comment_id)
+        # Whatever the commands were, the PR might have been updated.
+        self.q.mark_dirty(pull)
+        self.update_next_to_pending()
 
     # This method isn't very useful as if but at least it allows to easily
     # find where it's modified.
     def set_workflow(self, workflow):
         self.workflow = workflow
+        self.q.workflow = workflow
+        # Merge trains might have been enabled or disabled.
+        self.q.dirty_branches.update(self.q.approved_prs.heaps.keys())
 
     def update_status(self, pr, new_status):
         return self.q.update_status(pr, new_status)
@@ -707,13 +1254,20 @@ class Queues:
     def get_pr_from_head_commit(self, repo_name, head_commit):
         return self.repos[repo_name].get_pr_from_head_commit(head_commit)
 
+    @repo_name_checker
+    def update_head_commit(self, repo_name, pr_number, head_commit):
+        return self.repos[repo_name].update_head_commit(pr_number,
+                                                        head_commit)
+
     @repo_name_checker
     def get_queue(self, repo_name):
         return self.repos[repo_name].q
 
     @repo_name_checker
-    def parse_comment(self, repo_name, poster, pr_number, comment):
-        self.repos[repo_name].parse_comment(pr_number, poster, comment)
+    def parse_comment(self, repo_name, poster, pr_number, comment,
+                      comment_id=None):
+        self.repos[repo_name].parse_comment(pr_number, poster, comment,
+                                            comment_id)
 
     @repo_name_checker
     def add_pr(self, pr):
@@ -757,9 +1311,12 @@ class Queues:
                                         '"{}" organization.'
                                         .format(repo_name, self.org))
                         continue
-                    if get_prs(repo, updated,
-                               core.DB.get_pending_prs(repo.name),
-                               repo_workflow):
+                    with my_github.REQUEST_SCHEDULER.priority(
+                            const.GH_PRIORITY_BACKGROUND):
+                        loaded = get_prs(repo, updated,
+                                         core.DB.get_pending_prs(repo.name),
+                                         repo_workflow)
+                    if loaded:
                         core.LOGS.info('Repository "{}" is now being watched.'
                                        .format(repo_name))
                 else:
@@ -777,6 +1334,11 @@ class Queues:
         for value in self.repos.values():
             value.update_next_to_pending()
 
+    # Saves the changes of all queues in the database.
+    def save_snapshot(self):
+        for repo_name, repo in list(self.repos.items()):
+            repo.q.save_snapshot(repo_name)
+
 
 # For test only. It's cute and stuff. Don't mind it.
 class TestQueues:
@@ -787,24 +1349,58 @@ class TestQueues:
         return QueuesIterator(self.repos)
 
 
+# Called by get_all_prs in one of its worker threads.
+def load_repo(repo, repos, workflow, lock):
+    start = time.time()
+    loaded = {}
+    with my_github.REQUEST_SCHEDULER.priority(const.GH_PRIORITY_BACKGROUND):
+        get_prs(repo, loaded, core.DB.get_pending_prs(repo.name), workflow)
+    with lock:
+        repos.update(loaded)
+    core.LOGS.info('Repository "{}" loaded in {:.2f}s'
+                   .format(repo.name, time.time() - start))
+
+
 # Called by Queues class at its initialization.
+#
+# Most of the time is spent waiting for github and CI answers, so
+# repositories are loaded in parallel.
 def get_all_prs(repos, repo_list, workflows):
+    start = time.time()
+    to_load = OrderedDict()
     for repo in repo_list:
         for workflow in workflows:
             repo_workflow = workflow.get_repo(repo.name)
             if repo_workflow is None:
                 # Since no rights have been set for this repo, we skip it.
                 continue
-            get_prs(repo, repos, core.DB.get_pending_prs(repo.name),
-                    repo_workflow)
+            # If more than one workflow contains this repository, the last
+            # one wins.
+            to_load[repo.name] = (repo, repo_workflow)
+    lock = threading.Lock()
+    with ThreadPoolExecutor(max_workers=const.STARTUP_WORKERS) as executor:
+        futures = [executor.submit(load_repo, repo, repos, repo_workflow, lock)
+                   for repo, repo_workflow in to_load.values()]
+        for future in futures:
+            try:
+                future.result()
+            except Exception as e:
+                core.LOGS.error('get_all_prs error: {}'.format(e), e)
+    core.LOGS.info('{} repositories loaded in {:.2f}s'
+                   .format(len(to_load), time.time() - start))
     core.COMMENT_QUEUE.empty()
 
 
-def update_status(pendings, pr, q, repo):
+# `saved` is the PR's entry in the queue snapshot (if any), whose after list
+# and last read comment are kept.
+def update_status(pendings, pr, q, repo, saved=None):
     p = pendings[pr.number]
     # No need to parse comments.
     q_pr = PRQueueItem(p['priority'], [], const.PENDING, pr,
                        p['ci_url'], json.loads(p['env_args']), sha=p['sha'])
+    if saved is not None:
+        q_pr.afters = saved['afters']
+        q_pr.last_comment_id = saved['last_comment_id']
     ci_status = ci.get_ci_status(repo.name, repo.owner, q_pr.ci_url)
     res = False
     if ci_status == 'success':
@@ -814,23 +1410,75 @@ def update_status(pendings, pr, q, repo):
             q_pr.update_status(const.NOT_MERGEABLE)
     if res is False:
         q.add_pr(q_pr)
+    elif saved is not None:
+        # Merged, it won't be in the queue anymore.
+        q.removed.add(pr.number)
     del pendings[pr.number]
 
 
+# Creates a PRQueueItem from its entry in the queue snapshot.
+def restore_pr(saved, pr):
+    priority = saved['priority']
+    if priority != const.ROLLUP:
+        try:
+            priority = int(priority)
+        except Exception:
+            priority = 0
+    status = saved['status']
+    if status == const.PENDING:
+        # Its build isn't known anymore, it'll have to be tested again.
+        status = const.APPROVED
+    elif status not in EQS:
+        status = ''
+    q_pr = PRQueueItem(priority, saved['afters'], status, pr,
+                       env_args=saved['env_args'], sha=saved['sha'] or None)
+    q_pr.last_error = saved['last_error']
+    q_pr.last_comment_id = saved['last_comment_id']
+    return q_pr
+
+
 # Called by get_all_prs.
+#
+# PRs which are in the queue snapshot get their saved state back and only
+# their newer comments are parsed.
 def get_prs(repo, repos, pendings, workflow):
     try:
         core.LOGS.info("-> Getting PRs from {}".format(repo.name))
+        snapshot = core.DB.get_queue_snapshot(repo.name)
         q = PRQueue()
-        pr_list = repo.get_pulls()
+        try:
+            pr_list = repo.hydrate_pulls()
+        except Exception as e:
+            core.LOGS.error('get_prs: bulk loading of "{}" failed, falling '
+                            'back to the REST API: {}'.format(repo.name, e))
+            pr_list = repo.get_pulls()
+        to_parse = []
         for pr in pr_list:
+            saved = snapshot.pop(pr.number, None)
             if pr.number in pendings:
-                update_status(pendings, pr, q, repo)
+                update_status(pendings, pr, q, repo, saved)
                 continue
-            q_pr = PRQueueItem(0, [], "", pr)
+            since_id = 0
+            if saved is None:
+                q_pr = PRQueueItem(0, [], "", pr)
+            else:
+                q_pr = restore_pr(saved, pr)
+                since_id = q_pr.last_comment_id
             q.add_pr(q_pr)
+            to_parse.append((pr, q_pr, since_id))
+        # The comments which haven't been loaded along with their PRs are
+        # fetched all at once.
+        comments = my_github.gather(
+            [async_get_startup_comments(pr, pr.preloaded_comments, since_id)
+             for pr, q_pr, since_id in to_parse],
+            return_exceptions=True)
+        for (pr, q_pr, since_id), pr_comments in zip(to_parse, comments):
+            # Not needed anymore.
+            pr.preloaded_comments = None
             try:
-                parse_comments(q, pr, q_pr, workflow)
+                if isinstance(pr_comments, BaseException):
+                    raise pr_comments
+                parse_comments(q, q_pr, workflow, *pr_comments)
             except Exception as e:
                 core.LOGS.error('get_prs loop error: {}'.format(e), e)
                 continue
@@ -839,23 +1487,87 @@ def get_prs(repo, repos, pendings, workflow):
         # merged. Either way, we don't care, let's remove them from the db.
         for key in pendings.keys():
             core.DB.delete_pending_pr(repo.name, key)
+        # Same for the snapshot.
+        q.removed.update(snapshot.keys())
+        q.save_snapshot(repo.name)
         return True
     except Exception as e:
         core.LOGS.error('get_prs error: {}'.format(e), e)
     return False
 
 
-# Light version of PRQueueItem.parse_comment.
+def _is_approval_command(name):
+    return name in ['r', 'r+', 'r-']
+
+
+async def _async_iter_newest_first(comments):
+    for comment in reversed(comments):
+        yield comment
+
+
+# Returns the comments of `pr` which have to be replayed at startup (in their
+# original order) and the id of the newest one.
+#
+# Comments older than `since_id` have already been parsed: their result is in
+# the queue snapshot (status, priority, environment variables and after
+# list), so they're not read again. If the PR isn't in the snapshot, the
+# comments which have been loaded along with it are all replayed. Otherwise
+# pages are fetched lazily from the newest one and reading stops once both
+# the last r+/r-/r= command and the last after list have been found, so
+# priorities and environment variables set in older comments are lost for
+# these PRs (which have more than 100 comments and haven't been seen by a
+# previous run).
+async def async_get_startup_comments(pr, comments, since_id):
+    stop_early = comments is None and since_id == 0
+    found_approval = False
+    found_after = False
+    if comments is None:
+        comments = pr.async_iter_comments_newest_first()
+    else:
+        comments = _async_iter_newest_first(comments)
+    last_comment_id = since_id
+    to_parse = []
+    try:
+        async for comment in comments:
+            if comment.id is not None:
+                if comment.id <= since_id:
+                    break
+                last_comment_id = max(last_comment_id, comment.id)
+            if comment.author == core.USERNAME:
+                continue
+            to_parse.append(comment)
+            if stop_early is False:
+                continue
+            names = parse.get_commands_name(comment.message)
+            found_approval = found_approval or any(
+                [_is_approval_command(name) for name in names])
+            found_after = found_after or 'after' in names
+            if found_approval and found_after:
+                break
+    finally:
+        await comments.aclose()
+    to_parse.reverse()
+    return to_parse, last_comment_id
+
+
+# Light version of PRQueueItem.parse_comment, replaying the comments returned
+# by async_get_startup_comments.
 #
 # Some arguments/actions aren't executed (wouldn't make sense to run
 # r+/r-/r=/try multiple times, right?).
-def parse_comments(q, pr, q_pr, workflow):
+def parse_comments(q, q_pr, workflow, comments, last_comment_id):
     change = {'last': '', 'prs_to_check': []}
-    for comment in pr.get_comments():
-        if comment.author != core.USERNAME:
-            q.parse_comment(comment.author, q_pr, comment.message,
-                            workflow, last_r=change)
-    if len(change['last']) != 0 and change['last'] != 'r-':
+    q_pr.last_comment_id = max(q_pr.last_comment_id, last_comment_id)
+    names = set()
+    for comment in comments:
+        names.update(parse.get_commands_name(comment.message))
+    for comment in comments:
+        q.parse_comment(comment.author, q_pr, comment.message,
+                        workflow, last_r=change)
+    if change['last'] == 'r-':
+        # Only useful if the PR was approved in the snapshot.
+        q.update_status(q_pr, '')
+    elif len(change['last']) != 0:
         if change['last'] == 'r+':
             # If last r+/r- command is r+, we need to set the PR as approved.
             q.update_status(q_pr, const.APPROVED)
@@ -865,6 +1577,9 @@ def parse_comments(q, pr, q_pr, workflow):
             parse._parse_r_equal(['r', change['last']], q_pr, q, None)
     # To avoid checking every after url during startup, we only check last
     # ones.
+    if 'after' in names:
+        # They replace the ones from the snapshot.
+        q_pr.afters = []
     if len(change['prs_to_check']) > 0:
         check_after_urls(change['prs_to_check'], q_pr)
     # Would be problematic if all ultron's messages end up being sent now.
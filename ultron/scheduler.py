@@ -13,7 +13,7 @@ scheduler = sched.scheduler(time.time, time.sleep)
 
 def try_update_pendings():
     for queue in core.QUEUES:
-        queue['prs'].update_next_to_pending()
+        queue['prs'].update_waiting_branches()
 
 
 def sched_callback():
@@ -1,7 +1,6 @@
 import json
 import re
 import subprocess
-import tempfile
 # pip3 install py-gfm
 import markdown
 from mdx_gfm import GithubFlavoredMarkdownExtension
@@ -85,14 +84,18 @@ def check_github_url(url):
         pr_number = int(parts[3])
     except Exception:
         raise Exception('Not a valid pull request number')
+    pull = core.PULL_CACHE.get(parts[0], parts[1], pr_number)
+    if pull is not None:
+        return pull
     try:
-        # TODO/idea: write url cache to avoid performing useless GETs
-        return core.GITHUB.get_pull(parts[1], parts[0], url,
-                                    True, pr_number)
+        pull = core.GITHUB.get_pull(parts[1], parts[0], pr_number)
     except Exception as e:
         core.LOGS.error('check_github_url error: get_pull call failed: {}'
                         .format(e))
         raise Exception('No pull request found')
+    if pull is not None:
+        core.PULL_CACHE.store(parts[0], parts[1], pr_number, pull)
+    return pull
 
 
 def is_x_branch(branch):
@@ -156,6 +159,22 @@ def extract_error(out, err):
     return None
 
 
+# Same as extract_error but for the output of "git merge-tree --write-tree
+# --name-only": the tree's sha, the conflicting paths, an empty line and then
+# the merge messages.
+def extract_merge_tree_error(out):
+    parts = out.split('\n\n', 1)
+    r = '\n'.join([line for line in parts[-1].split('\n')
+                   if line.startswith('CONFLICT')]) if len(parts) > 1 else ''
+    if len(r) == 0:
+        r = '\n'.join(['Merge conflict in {}'.format(path)
+                       for path in parts[0].split('\n')[1:]
+                       if len(path) != 0])
+    if len(r) != 0:
+        return '\n```\n{}\n```'.format(r)
+    return None
+
+
 def exec_commands(commands, func_name, logs=False):
     for command in commands:
         try:
@@ -231,76 +250,128 @@ def is_forward_port(folder):
         return False
 
 
+# Runs the merge (and push if `do_push` is True) of the PR in a worktree of
+# the target repository's mirror (see MirrorCache). Its HEAD is always
+# detached: the mirror's branches and the PR's head (even if it comes from a
+# fork) are used directly and the pushes go to github.
 def make_pr_commands(pr, do_push, function_name, logs=False):
-    from_repo_url = add_key_repo_url(pr.get_from_repo_url())
-    target_repo_url = add_key_repo_url(pr.get_repo_url())
-    with tempfile.TemporaryDirectory() as tmpdirname:
-        commands = [
-            ['git', 'clone', from_repo_url, '--depth',
-             str(pr.get_number_of_commits() + 1), '-b', pr.from_branch(),
-             tmpdirname],
-            ['bash', '-c', 'cd {} && git remote add upstream "{}"'.format(
-                tmpdirname, target_repo_url)],
-            # TODO: Would be nice to fetch only one branch
-            ['bash',
-             '-c', 'cd {} && git fetch upstream'.format(
-                tmpdirname)]]
-        ret, stdout = exec_commands(commands, function_name, logs=True)
+    with core.MIRRORS.lease_worktree(pr.get_repo_url()) as folder:
+        if folder is None:
+            return (False, 'Failed to update the repository mirror')
+        return make_pr_commands_in_worktree(pr, do_push, function_name,
+                                            folder, logs=logs)
+
+
+# Merges the PR on top of the `base` commit (without committing) in the
+# worktree `folder`, the way PRs are merged: its commits are rebased on `base`
+# first and then merged, unless it's a forward port (its last commit is a
+# merge) in which case it's merged directly.
+def merge_pr_in_worktree(pr, base, function_name, folder, logs=False):
+    pr_head = 'refs/pull/{}/head'.format(pr.number())
+    ret, stdout = exec_commands(
+        [['bash', '-c', 'cd {} && git checkout --quiet --detach {}'.format(
+            folder, pr_head)]],
+        function_name, logs=True)
+    if ret is False:
+        return (False, stdout)
+    if is_forward_port(folder):
+        commands = [['bash', '-c', 'cd {} && git checkout --quiet --detach {}'
+                     .format(folder, base)]]
+        if pr.sha is None:
+            commands.append(
+                ['bash', '-c', 'cd {} && git merge --no-ff --no-edit '
+                 '--no-commit {}'.format(folder, pr_head)])
+        else:
+            commands.append(
+                ['bash', '-c', 'cd {} && git merge --no-ff --no-edit '
+                 '--no-commit {} HEAD {}'.format(folder, pr_head, pr.sha)])
+    else:
+        # To group all remote branch's commits, we rebase first and then we
+        # merge.
+        ret, stdout = exec_commands(
+            [['bash', '-c', 'cd {} && git rebase {}'.format(folder, base)]],
+            function_name, logs=logs)
         if ret is False:
             return (False, stdout)
-        if is_forward_port(tmpdirname):
-            commands = [['bash', '-c', 'cd {} && git checkout upstream/{}'
-                        .format(tmpdirname, pr.target_branch())]]
-            if pr.sha is None:
-                commands.append(
-                    ['bash', '-c', 'cd {} && git merge --no-ff --no-edit '
-                     '--no-commit origin/{}'.format(tmpdirname,
-                                                    pr.from_branch())])
-            else:
-                commands.append(
-                    ['bash', '-c', 'cd {} && git merge --no-ff --no-edit '
-                     '--no-commit origin/{} HEAD {}'.format(
-                        tmpdirname, pr.from_branch(), pr.sha)])
+        if pr.sha is None:
+            ret, stdout, stderr = exec_command(
+                ['bash', '-c', 'cd {} && git rev-parse HEAD'.format(folder)])
+            if ret is False:
+                return (False, None)
+            merged = stdout.strip()
         else:
-            commands = [
-                # To group all remote branch's commits, we rebase first and
-                # then we merge.
-                ['bash', '-c', 'cd {} && git rebase upstream/{}'.format(
-                    tmpdirname, pr.target_branch())],
-                ['bash', '-c', 'cd {} && git checkout upstream/{}'.format(
-                    tmpdirname, pr.target_branch())],
-                ['bash', '-c', 'cd {} && git merge --no-ff --no-edit '
-                 '--no-commit {}'
-                 .format(tmpdirname, pr.from_branch())]]
-            if pr.sha is not None:
-                commands[2] = [
-                    'bash', '-c', 'cd {} && git merge --no-ff --no-edit '
-                    '--no-commit origin/{} HEAD {}'.format(
-                        tmpdirname, pr.from_branch(), pr.sha)
-                ]
-        if do_push:
-            commands.append(['bash', '-c',
-                             'cd {0} && git commit -m "merge #{1}" '
-                             '--author="{2} <{2}@orga.com>"'
-                             .format(tmpdirname, pr.number(), core.USERNAME)])
-            commands.append(['bash', '-c',
-                             'cd {} && git push upstream HEAD:{}'.format(
-                                 tmpdirname, pr.target_branch())])
-            # If the from branch is on the target repo, then we delete it.
-            if pr.get_from_repo_url() == pr.get_repo_url():
-                commands.append([
-                    'bash', '-c', 'cd {} && git push upstream --delete {}'
-                        .format(tmpdirname, pr.from_branch())])
-        return exec_commands(commands, function_name, logs=logs)
+            merged = '{} HEAD {}'.format(pr_head, pr.sha)
+        commands = [
+            ['bash', '-c', 'cd {} && git checkout --quiet --detach {}'.format(
+                folder, base)],
+            ['bash', '-c', 'cd {} && git merge --no-ff --no-edit '
+             '--no-commit {}'.format(folder, merged)]]
+    return exec_commands(commands, function_name, logs=logs)
+
+
+def make_pr_commands_in_worktree(pr, do_push, function_name, folder,
+                                 logs=False):
+    ret, stdout = merge_pr_in_worktree(
+        pr, 'refs/heads/{}'.format(pr.target_branch()), function_name,
+        folder, logs=logs)
+    if ret is False or not do_push:
+        return (ret, stdout)
+    commands = []
+    repo_url = add_key_repo_url(pr.get_repo_url())
+    commands.append(['bash', '-c',
+                     'cd {0} && git commit -m "merge #{1}" '
+                     '--author="{2} <{2}@orga.com>"'
+                     .format(folder, pr.number(), core.USERNAME)])
+    commands.append(['bash', '-c',
+                     'cd {} && git push "{}" HEAD:refs/heads/{}'.format(
+                         folder, repo_url, pr.target_branch())])
+    # If the from branch is on the target repo, then we delete it.
+    if pr.get_from_repo_url() == pr.get_repo_url():
+        commands.append([
+            'bash', '-c', 'cd {} && git push "{}" --delete {}'
+                .format(folder, repo_url, pr.from_branch())])
+    return exec_commands(commands, function_name, logs=logs)
+
+
+# Merges the PR's head into its target branch in the mirror's object database
+# only (no checkout needed), which is a lot faster than running
+# make_pr_commands. Returns None if it couldn't be done (git older than 2.38
+# for example).
+def check_with_merge_tree(pr):
+    with core.MIRRORS.lease(pr.get_repo_url()) as mirror_path:
+        if mirror_path is None:
+            return None
+        command = ['git', '-C', mirror_path, 'merge-tree', '--write-tree',
+                   '--name-only', 'refs/heads/{}'.format(pr.target_branch()),
+                   'refs/pull/{}/head'.format(pr.number())
+                   if pr.sha is None else pr.sha]
+        try:
+            ret, stdout, stderr = exec_command(
+                command, timeout=const.MIRROR_FETCH_TIMEOUT)
+        except subprocess.TimeoutExpired:
+            core.LOGS.error('check_with_merge_tree timed out on "{}"'.format(
+                            ' '.join(command)))
+            return None
+    # If there are conflicts, it fails too but the tree's sha is still there.
+    if ret is False and SHA_PATTERN.fullmatch(stdout.split('\n')[0]) is None:
+        core.LOGS.error('check_with_merge_tree failed on "{}":\n{}'.format(
+                        ' '.join(command), join_outputs(stdout, stderr)))
+        return None
+    if ret is False:
+        return (False, extract_merge_tree_error(stdout))
+    return (True, None)
 
 
-# Checking if a PR is mergeable through a rebase instead of a merge seemed
-# easier for me.
+# Checking if a PR is mergeable through a merge of trees is much faster. If it
+# can't be done, we go back to the rebase (and merge) in a worktree.
 def check_if_mergeable(pr):
     core.LOGS.info('Checking if {}#{} from {} into {} is mergeable.'
                    .format(pr.repo_name(), pr.number(), pr.from_branch(),
                            pr.target_branch()))
     try:
+        ret = check_with_merge_tree(pr)
+        if ret is not None:
+            return ret
         return make_pr_commands(pr, False, 'check_if_mergeable', logs=True)
     except Exception as e:
         core.LOGS.error('check_if_mergeable failed: (PR #{} from {} to {})\n{}'
@@ -317,6 +388,8 @@ def merge_pr(pr):
     try:
         ret, stdout = make_pr_commands(pr, True, 'merge_pr')
         if ret is True:
+            core.PULL_CACHE.invalidate(pr.repo_owner(), pr.repo_name(),
+                                       pr.number())
             core.LOGS.info('PR "{}" has been successfully merged into {}.'
                            .format(pr.get_url(), pr.target_branch()))
         return (ret, stdout)
@@ -325,6 +398,111 @@ def merge_pr(pr):
     return (False, None)
 
 
+# Merges the given PRs (PRQueueItem) one after the other on top of their
+# target branch (or on top of the `base_sha` commit of `base_branch`) and
+# pushes the result on `integration_branch` of the target repository. PRs
+# which can't be merged are skipped.
+#
+# Returns the sha of the pushed commit (None if it failed) and a dictionary
+# containing the skipped PRs' numbers associated with the merge errors.
+def make_integration_branch(prs, integration_branch, function_name,
+                            base_branch=None, base_sha=None):
+    target = prs[0]
+    errors = {}
+    with core.MIRRORS.lease_worktree(target.get_repo_url()) as folder:
+        if folder is None:
+            return (None, errors)
+        return make_integration_branch_in_worktree(
+            prs, integration_branch, function_name, folder, errors,
+            base_branch, base_sha)
+
+
+def make_integration_branch_in_worktree(prs, integration_branch,
+                                        function_name, folder, errors,
+                                        base_branch, base_sha):
+    target = prs[0]
+    if base_sha is None:
+        base_sha = 'refs/heads/{}'.format(
+            base_branch if base_branch is not None
+            else target.target_branch())
+    ret, stdout = exec_commands(
+        [['bash', '-c', 'cd {} && git checkout --quiet --detach {}'.format(
+            folder, base_sha)]],
+        function_name)
+    if ret is False:
+        return (None, errors)
+    merged = 0
+    for pr in prs:
+        ret, stdout, stderr = exec_command(
+            ['bash', '-c', 'cd {} && git rev-parse HEAD'.format(folder)])
+        if ret is False:
+            return (None, errors)
+        base = stdout.strip()
+        # Merged the same way as when it's merged alone.
+        ret, stdout = merge_pr_in_worktree(pr, base, function_name, folder)
+        if ret is True:
+            ret, stdout = exec_commands(
+                [['bash', '-c', 'cd {0} && git commit -m "merge #{1}" '
+                  '--author="{2} <{2}@orga.com>"'.format(
+                    folder, pr.number(), core.USERNAME)]],
+                function_name)
+        if ret is False:
+            errors[pr.number()] = stdout
+            # Back to the previous PR's merge.
+            for command in ['rebase --abort', 'merge --abort',
+                            'checkout --quiet --force --detach {}'.format(
+                                base)]:
+                exec_command(['bash', '-c', 'cd {} && git {}'.format(
+                    folder, command)])
+            continue
+        merged += 1
+    if merged == 0:
+        return (None, errors)
+    ret, stdout = exec_commands(
+        [['bash', '-c', 'cd {} && git push -f "{}" HEAD:refs/heads/{}'
+          .format(folder, add_key_repo_url(target.get_repo_url()),
+                  integration_branch)]],
+        function_name, logs=True)
+    if ret is False:
+        return (None, errors)
+    ret, stdout, stderr = exec_command(
+        ['bash', '-c', 'cd {} && git rev-parse HEAD'.format(folder)])
+    if ret is False:
+        return (None, errors)
+    return (stdout.strip(), errors)
+
+
+# Pushes the (tested) `sha` commit of the last integration branch on the
+# target branch of the given PRs, merging them all at once, and then removes
+# the integration branches. It fails if the target branch has been updated in
+# the meantime.
+def push_integration_branch(prs, integration_branches, sha, function_name):
+    target = prs[0]
+    repo_url = add_key_repo_url(target.get_repo_url())
+    with core.MIRRORS.lease_worktree(target.get_repo_url()) as folder:
+        if folder is None:
+            return (False, None)
+        commands = [
+            # The integration branch might have been overwritten, so the sha
+            # is pushed directly.
+            ['bash', '-c', 'cd {} && git push "{}" {}:refs/heads/{}'.format(
+                folder, repo_url, sha, target.target_branch())],
+            ['bash', '-c', 'cd {} && git push "{}" --delete {}'.format(
+                folder, repo_url, ' '.join(integration_branches))]]
+        # If the from branches are on the target repo, then we delete them.
+        for pr in prs:
+            if pr.get_from_repo_url() == pr.get_repo_url():
+                commands.append([
+                    'bash', '-c', 'cd {} && git push "{}" --delete {}'
+                    .format(folder, repo_url, pr.from_branch())])
+        ret, stdout = exec_commands(commands, function_name, logs=True)
+        if ret is True:
+            for pr in prs:
+                core.PULL_CACHE.invalidate(pr.repo_owner(), pr.repo_name(),
+                                           pr.number())
+        return (ret, stdout)
+
+
 # Takes a dictionary as first argument and then keys.
 def safe_get(*args):
     c = args[0].get(args[1], None)
@@ -4,7 +4,8 @@ from ultron.utils import compute_repo_envvar
 
 
 class RepositoryWorkflow:
-    def __init__(self, reviewers, branch_mappings, workflow):
+    def __init__(self, reviewers, branch_mappings, workflow,
+                 merge_trains={}, batches={}):
         self.workflow = workflow
         # This list corresponds to the users who have the rights to call some
         # specific commands like 'r+', 'r-' or 'clean' or any command modifying
@@ -14,6 +15,12 @@ class RepositoryWorkflow:
         self.reviewers = [r.lower() for r in reviewers]
         self.mapping = branch_mappings
         self.reverse_mapping = {v: k for k, v in self.mapping.items()}
+        # Target branch -> maximum number of PRs tested at the same time, each
+        # one on top of the ones before it.
+        self.merge_trains = merge_trains
+        # Target branch -> maximum number of PRs tested together in a single
+        # build.
+        self.batches = batches
 
     def has_permission(self, user):
         if len(self.reviewers) == 0:
@@ -37,6 +44,14 @@ class RepositoryWorkflow:
     def get_tester_repository(self):
         return self.workflow.get_tester_repository()
 
+    # 1 means that the PRs of the branch are tested one by one.
+    def get_merge_train_depth(self, branch_name):
+        return self.merge_trains.get(branch_name, 1)
+
+    # 1 means that the PRs of the branch aren't tested in batches.
+    def get_batch_size(self, branch_name):
+        return self.batches.get(branch_name, 1)
+
     def branch_map(self, branch_name):
         """ Maps a branch name according to the workflow's mappings.
             As this function is intended to be used to map the DEFAULT_BRANCH,
@@ -73,7 +88,9 @@ class Workflow:
             self.repositories_workflow[repo['name']] = \
                 RepositoryWorkflow(repo['reviewers'],
                                    repo['branch_mapping'],
-                                   self)
+                                   self,
+                                   repo.get('merge_trains', {}),
+                                   repo.get('batches', {}))
 
     def load(self, gh_token):
         self.gh_token = gh_token